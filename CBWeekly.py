@@ -1,16 +1,38 @@
 # This script creates the Month over Month view for the Credit Building portfolio
 
-# This version of the script regenerates the whole file from scratch.
-# Use this version of the script if some data issues have been identified (after the issues have been fixed)
+# By default the script runs incrementally: it reads the last snapshot stored in the output table,
+# computes only the new week(s) and appends them.
+# Run with --rebuild to regenerate the whole file from scratch.
+# Use --rebuild if some data issues have been identified (after the issues have been fixed)
 # in the underlying feeder files
 
 import pandas as pd
-import pandas_gbq as pgbq
 from time import strftime
 import datetime
+import os
 import numpy as np
 from datetime import date
 
+import aging
+import backends
+import fetch_pool
+import change_detection
+import checkpoint
+import cubes
+import incremental
+import preflight
+import query_cache
+import replay_engine
+import sharding
+import status_index
+from base_tables import BaseTables
+import rules
+import snapshot_lookup
+import uploader
+from frame_collector import FrameCollector, compact, convert_dates
+from run_options import parse_run_args
+from run_report import RunReport
+
 def next_weekday(d, weekday):
     days_ahead = weekday - d.weekday()
     if days_ahead <= 0: # Target day already happened this week
@@ -43,9 +65,29 @@ periods = pd.date_range(start='2022-04-01',
                        freq='W') # W for weekly M for monthly
 periods
 
-def loans_by_period(start, end):
-    
-    query = """with all_trans as (select 
+# The views that can be derived from the same daily state of the replay engine (--views, see select_view):
+# period grid, output table and cohort of each. The first period end of a grid only opens the first period.
+# A custom view takes its period ends and output table from the command line
+views = {'weekly': (periods, out_table, replay_engine.week_end),
+         'monthly': (pd.date_range(start='2022-03-31', end=curr_week_end, freq=pd.offsets.MonthEnd()),
+                     'credit.CB_finance_view_monthly', replay_engine.month_end)}
+view = 'weekly'
+cohort = replay_engine.week_end
+
+# The data source, BigQuery unless another backend is chosen on the command line (see backends.py)
+backend = backends.BigQueryBackend(project_id)
+
+def read_query(query, period_end=None):
+    return backend.read(query)
+
+def execute(statement):
+    # Runs a statement that returns no rows (DDL / DML)
+    backend.execute(statement)
+
+# The period query is put together from three parts, the middle part either pairs every withdrawal with
+# the next one and range joins the repayments onto it (join_staging, quadratic in the number of withdrawals
+# per user) or gets the same columns from window aggregates over the transactions (window_staging)
+query_head = """with all_trans as (select 
     distinct b.user_reference, 
     a.UserAccount 
     from kohoapi.transaction_succeeded_events as a
@@ -125,11 +167,13 @@ def loans_by_period(start, end):
     where a.PaymentCode in ('CRB-TR-A-I-002') and date(a.PostedAt,'America/Denver') <= '{1}' 
         order by a.UserAccount, a.PostedAt), 
     
+    -- transactions posted at the same time are ordered by TransactionID, recency 1 is the last transaction of the user
     raw as (select *, 
 
     CAST (sum(amount) 
         over (partition by user_reference 
-            order by PostedAt asc rows between unbounded preceding and current row) AS FLOAT64) as OS
+            order by PostedAt asc, TransactionID asc rows between unbounded preceding and current row) AS FLOAT64) as OS,
+    row_number() over (partition by user_reference order by PostedAt desc, TransactionID desc) as recency
 
     from (select * from withdraw 
 
@@ -138,14 +182,17 @@ def loans_by_period(start, end):
     select * from repay
 
     order by 1,2,3)),
-    
+"""
+
+join_staging = """    
     paired_withdraw as (select 
         a.*, 
         min(b.PostedAt) as next_withdrawal_date,
         from withdraw as a 
             left join withdraw as b 
             on a.user_reference = b.user_reference 
-                and a.PostedAt < b.PostedAt group by 1,2,3,4,5,6,7 order by 1,2,3),
+                and (a.PostedAt < b.PostedAt or (a.PostedAt = b.PostedAt and a.TransactionID < b.TransactionID))
+            group by 1,2,3,4,5,6,7 order by 1,2,3),
     
     grouped_withdraw_repay as (select 
        a.*, 
@@ -157,11 +204,15 @@ def loans_by_period(start, end):
             or (a.next_withdrawal_date is null and b.PostedAt >= a.PostedAt))
         group by 1,2,3,4,5,6,7,8),
         
+    -- the latest withdrawal, the one with the highest TransactionID of withdrawals posted at the same time
     grouped_repay as (select a.user_reference, a.PostedAt as PrevWithdrawDate, a.RepaymentDate, a.RepaymentAmount  
         from grouped_withdraw_repay as a 
         inner join 
-            (select user_reference, max(PostedAt) as PostedAt from grouped_withdraw_repay group by 1) as b 
-        on a.user_reference = b.user_reference and a.PostedAt = b.PostedAt
+            (select c.user_reference, c.PostedAt, max(c.TransactionID) as TransactionID 
+                from grouped_withdraw_repay as c 
+                inner join (select user_reference, max(PostedAt) as PostedAt from grouped_withdraw_repay group by 1) as d 
+                on c.user_reference = d.user_reference and c.PostedAt = d.PostedAt group by 1,2) as b 
+        on a.user_reference = b.user_reference and a.PostedAt = b.PostedAt and a.TransactionID = b.TransactionID
         where RepaymentDate IS NOT NULL),
     
     staging as (select 
@@ -201,8 +252,61 @@ def loans_by_period(start, end):
                     group by 1) as d 
             on a.user_reference = d.user_reference
             left join 
-                grouped_repay as e on a.user_reference = e.user_reference and a.PostedAt = e.RepaymentDate),
-
+                grouped_repay as e on a.user_reference = e.user_reference and a.PostedAt = e.RepaymentDate
+        where a.recency = 1),
+"""
+
+window_staging = """    
+    -- Single pass over raw: the last transaction and the latest withdrawal of every user
+    windowed as (select *,
+        max(PostedAt) over (partition by user_reference) as last_TR,
+        max(if(TR_Desc = 'Borrow', PostedAt, null)) over (partition by user_reference) as LastWithdrawDate
+        from raw),
+    
+    -- Only the repayments grouped on the latest withdrawal are needed for the due date,
+    -- i.e. the repayments made on or after it
+    grouped_repay as (select 
+        user_reference, 
+        max(LastWithdrawDate) as PrevWithdrawDate, 
+        max(PostedAt) as RepaymentDate, 
+        sum(Amount) as RepaymentAmount 
+        from windowed 
+        where TR_Desc = 'Repay' and PostedAt >= LastWithdrawDate 
+        group by 1),
+    
+    in_week as (select 
+        user_reference, 
+        sum(if(TR_Desc = 'Borrow', Amount, null)) as withdrawals, 
+        -sum(if(TR_Desc = 'Repay', Amount, null)) as repayments 
+        from raw 
+        where last_day(date(PostedAt), week(monday)) = '{1}' 
+        group by 1),
+    
+    staging as (select 
+        a.user_reference, 
+        a.last_TR,
+        a.TR_Desc as Last_TR_Desc,
+        CASE 
+            when a.OS BETWEEN -0.01 and 0.01 then 0
+            else a.OS
+        END as OS,
+        c.withdrawals as in_month_withdrawals,
+        c.repayments as in_month_repayments,
+        e.PrevWithdrawDate,
+        -e.RepaymentAmount as RepaymentAmount,
+        case
+            when PrevWithdrawDate is not null then -e.RepaymentAmount + a.OS
+            else a.OS
+        end as prev_OS
+        from windowed as a
+            left join in_week as c on a.user_reference = c.user_reference
+            left join grouped_repay as e on a.user_reference = e.user_reference and a.PostedAt = e.RepaymentDate
+        where a.recency = 1),
+"""
+
+# query_dates works out the due date and the status of every accessed user (aging.py does the same locally),
+# query_select puts the accounts together
+query_dates = """
 date_calc as (select 
     user_reference, 
     last_TR, 
@@ -254,7 +358,9 @@ date_calc as (select
                 and date_diff('{1}', date(due_date), DAY) >= 91 then "5. 91+"
             else "1. Current"
         end as status
-        from date_calc)
+        from date_calc)"""
+
+query_select = """
         
 select 
     a.snapshot,
@@ -303,27 +409,86 @@ select
         on a.user_reference = b.user_reference
     
     -- remove any stale accounts
-    where not (a.status = 'cancelled' and last_day(date(a.updated_at), MONTH) < date('{1}'))""".format(start, end)
+    where not (a.status = 'cancelled' and last_day(date(a.updated_at), MONTH) < date('{1}'))"""
 
-    loans = pgbq.read_gbq(query, project_id, dialect='standard')
-    
-    return loans
+query_tail = query_dates + query_select
 
-# initializing curr_loans
-curr_loans = loans_by_period(periods[0].strftime('%Y-%m-%d'),periods[periods.size-1].strftime('%Y-%m-%d'))
+def period_query(start, end, window=False):
+    staging = window_staging if window else join_staging
+    return (query_head + staging + query_tail).format(start, end)
 
-curr_loans.head()
+def aging_query(start, end):
+    # The due date inputs, due date and status of every accessed user as of end (date_calc and accessed)
+    return (query_head + join_staging + query_dates + """
+select a.user_reference, a.last_TR as last_TR, a.PrevWithdrawDate as PrevWithdrawDate, a.RepaymentAmount as RepaymentAmount,
+    a.Prev_OS as Prev_OS, a.OS as OS, a.due_date as due_date, b.status as status
+    from date_calc as a inner join accessed as b on a.user_reference = b.user_reference""").format(start, end)
 
-# creating stacked dataset
-i = 1
-while i < periods.size-1:
-    curr_loans = pd.concat([curr_loans, loans_by_period(periods[0].strftime('%Y-%m-%d'),periods[i].strftime('%Y-%m-%d'))], ignore_index=True)
-    i += 1
+def loans_by_period(start, end, read=read_query, window=False):
+    
+    query = period_query(start, end, window)
 
-curr_loans.shape
+    loans = read(query, end)
+    
+    return loans
 
-# A bit of code to speed up execution later
-# We split out those accounts that have been accessed (much smaller group) and treat them separately
+def stack_periods(ends, options, read=read_query, progress=None):
+    # fetch the periods concurrently and stack them in the order of ends
+    # periods recorded in the checkpoint (progress) by a previous failed run are not fetched again
+    start = periods[0].strftime('%Y-%m-%d')
+    collector = FrameCollector(options.memory_budget, options.spill_dir)
+
+    pending = list(range(len(ends)))
+    if progress is not None:
+        for position, path in progress.completed().items():
+            collector.add_file(path, position)
+        pending = progress.pending(len(ends))
+        if len(ends) > len(pending):
+            print("Resuming, " + str(len(ends) - len(pending)) + " out of " + str(len(ends)) + " periods already fetched")
+
+    def on_result(frame, i):
+        position = pending[i]
+        if progress is not None:
+            frame = progress.record(frame, position, ends[position])
+        collector.add(frame, position)
+
+    fetch_pool.fetch_all([ends[i] for i in pending], lambda end: loans_by_period(start, end.strftime('%Y-%m-%d'), read, options.window_query),
+                         workers=options.workers, retries=options.retries, backoff=options.backoff,
+                         on_result=on_result)
+    return collector.result()
+
+# The transactions are replayed up to this date if it is later than the last period end (set by main to the
+# last period end of all the views of the run). The daily state of the last replay is kept for the next view
+# reading through the same read
+horizon = None
+daily = None
+
+def select_view(name, grid=None, table=None):
+    # Makes the functions below work on the period grid and output table of a view
+    global view, periods, out_table, cohort
+    if name == 'custom':
+        periods, out_table, cohort = pd.DatetimeIndex(sorted(pd.to_datetime(grid))), table, replay_engine.grid_cohort(grid)
+    else:
+        periods, out_table, cohort = views[name]
+    view = name
+
+def replay_periods(ends, options, read=read_query, progress=None, users=None):
+    # Same rows as stack_periods, from a single pull of the CRB transactions (see replay_engine.py)
+    global daily
+    end = max(ends) if horizon is None else max(max(ends), horizon)
+    query = replay_engine.transactions_query(replay_engine.CreditBuildingPolicy.codes, end.strftime('%Y-%m-%d'), users)
+    if users is not None or daily is None or daily[0] is not read or daily[1] != query:
+        loans = read(replay_engine.loans_query())
+        policy = replay_engine.CreditBuildingPolicy(loans)
+        transactions = read(query, end)
+        state = replay_engine.daily_state(transactions, policy)
+        if users is not None:
+            return compact(replay_engine.resample(state, ends, policy, periods, cohort))
+        daily = (read, query, policy, state)
+    policy, state = daily[2:]
+    return compact(replay_engine.resample(state, ends, policy, periods, cohort))
+
+# Accounts that have ever been accessed (made a withdrawal)
 
 ever_query = """select 
     distinct b.user_reference,
@@ -336,116 +501,392 @@ ever_query = """select
     where a.PaymentCode in ('CRB-TR-A-I-001')
         group by 1,2"""
 
-ever = pgbq.read_gbq(ever_query, project_id, dialect='standard')
-
-# adding ever accessed flag
-
-curr_loans = curr_loans.merge(ever, how='left', left_on=["user_reference", "account_identifier"], right_on=["user_reference","account_identifier"])
-
-
-curr_loans.shape
-
-curr_loans['ever_accessed'].value_counts()
-
-curr_loans_2 = curr_loans.copy(deep=True)
-
-# curr_loans_2['days_between_curr_and_dep'] = ((curr_loans_2['snapshot'] - curr_loans_2['dep_date'])/np.timedelta64(1,'D')).astype(int)
-# curr_loans_2['days_between_paid_and_due'] = ((curr_loans_2['update_date'] - curr_loans_2['due_date'])/np.timedelta64(1,'D')).astype(int)
-# curr_loans_2['days_between_curr_and_paid'] = ((curr_loans_2['snapshot'] - curr_loans_2['update_date'])/np.timedelta64(1,'D')).astype(int)
-# curr_loans_2['days_between_curr_and_due'] = ((curr_loans_2['snapshot'] - curr_loans_2['due_date'])/np.timedelta64(1,'D')).astype(int)
-
-curr_loans_2.head()
-
-for i in range(len(curr_loans.columns)):
-    if(curr_loans.dtypes.values[i] == "dbdate"):
-        curr_loans[curr_loans.columns[i]]= pd.to_datetime(curr_loans[curr_loans.columns[i]])
-
-# Delete snapshots that are greater than the current month
-curr_week_end = np.datetime64(curr_week_end)
-final = curr_loans_2[curr_loans_2.snapshot <= curr_week_end]
-
-
-# File will be split into two for further processing to speed up execution
-final_accessed = final[final.ever_accessed == 'Yes']
-
-# Sort
-final_accessed.sort_values(['user_reference', 'snapshot'], inplace = True)
-
-# reset index
-final_accessed.reset_index(drop=True, inplace=True)
-
-final_accessed.to_csv('accessed2.csv', index=True)
-
-
-# add prev dlq bucket
-final_accessed['prev_status'] = '0. New'
-
-# add new loan flag
-final_accessed['new_loan'] = 'No'
-
-for ind in final_accessed.index:
-    if ind == 0 and final_accessed['snapshot'][ind] == final_accessed['cohort_end'][ind]:
-        final_accessed['prev_status'][ind] = '0. non existent'
-        final_accessed['new_loan'][ind] = 'Yes'
-    elif ind == 0 and final_accessed['snapshot'][ind] != final_accessed['cohort_end'][ind]:
-        final_accessed['prev_status'][ind] = '1. Current'
-        final_accessed['new_loan'][ind] = 'No'
-    else:
-        if final_accessed['account_identifier'][ind] == final_accessed['account_identifier'][ind-1]:
-            final_accessed['prev_status'][ind] = final_accessed['snapshot_status'][ind-1]
-        elif final_accessed['account_identifier'][ind] != final_accessed['account_identifier'][ind-1]:
-            if final_accessed['snapshot'][ind] == final_accessed['cohort_end'][ind]:
-                final_accessed['prev_status'][ind] = '0. non existent'
-                final_accessed['new_loan'][ind] = 'Yes'
-            elif final_accessed['snapshot'][ind] != final_accessed['cohort_end'][ind]:
-                final_accessed['prev_status'][ind] = '1. Current'
-                final_accessed['new_loan'][ind] = 'No'
-            
-# Add new default flag
-final_accessed['new_default'] = '3. NA'
-
-for ind in final_accessed.index:
-    if final_accessed['snapshot_status'][ind] == '5. 91+':
-        if final_accessed['prev_status'][ind] != '5. 91+':
-            final_accessed['new_default'][ind] = '1. Yes'
+def add_ever_accessed(curr_loans, read=read_query):
+    ever = read(ever_query)
+
+    return merge_ever_accessed(curr_loans, ever)
+
+def merge_ever_accessed(curr_loans, ever):
+    # adding ever accessed flag
+    return curr_loans.merge(ever, how='left', left_on=["user_reference", "account_identifier"], right_on=["user_reference","account_identifier"])
+
+# Status flags, each rule is (condition, label) in priority order (see rules.py)
+# Accessed accounts are reported with prev_status '0. non existent' and new_loan '0. No',
+# their previous status (prev_row_status) only feeds the new default flag
+status_rules = {
+    'prev_status': ([(lambda d: d['ever_accessed'] == 'Yes', '0. non existent'),
+                     (lambda d: d['snapshot'] == d['cohort_end'], '0. non existent')],
+                    '1. Current'),
+    'new_loan': ([(lambda d: d['ever_accessed'] == 'Yes', '0. No'),
+                  (lambda d: d['snapshot'] == d['cohort_end'], '1. Yes')],
+                 '0. No'),
+    'new_default': ([(lambda d: (d['ever_accessed'] == 'Yes') & (d['snapshot_status'] == '5. 91+') & (d['prev_row_status'] != '5. 91+'), '1. Yes'),
+                     (lambda d: (d['ever_accessed'] == 'Yes') & (d['snapshot_status'] == '5. 91+'), '2. No')],
+                    '3. NA'),
+}
+
+def order_snapshots(curr_loans):
+    # curr_loans['days_between_curr_and_dep'] = ((curr_loans['snapshot'] - curr_loans['dep_date'])/np.timedelta64(1,'D')).astype(int)
+    # curr_loans['days_between_paid_and_due'] = ((curr_loans['update_date'] - curr_loans['due_date'])/np.timedelta64(1,'D')).astype(int)
+    # curr_loans['days_between_curr_and_paid'] = ((curr_loans['snapshot'] - curr_loans['update_date'])/np.timedelta64(1,'D')).astype(int)
+    # curr_loans['days_between_curr_and_due'] = ((curr_loans['snapshot'] - curr_loans['due_date'])/np.timedelta64(1,'D')).astype(int)
+
+    # Delete snapshots that are greater than the current month
+    final = curr_loans[curr_loans.snapshot <= np.datetime64(curr_week_end)]
+
+    # Sort
+    final = final.sort_values(['user_reference', 'snapshot'], kind='mergesort').reset_index(drop=True)
+
+    # For accessed accounts the previous status is the status on the previous row if it is the same account
+    acc = final.loc[final['ever_accessed'] == 'Yes', ['account_identifier', 'snapshot', 'snapshot_status']]
+    final['prev_row_status'] = snapshot_lookup.previous_values(acc, 'account_identifier', 'snapshot_status')
+
+    return final
+
+def classify(final):
+    # add prev dlq bucket, new loan and new default flags
+    return rules.evaluate(final, status_rules).drop(columns=['prev_row_status'])
+
+def add_transitions(curr_loans):
+    return classify(order_snapshots(curr_loans))
+
+def process_shard(transactions, loans, ever, ends, prev=None, since=None, view='weekly', grid=None, table=None):
+    # One shard of users end to end in a worker process (see sharding.py)
+    select_view(view, grid, table)
+    curr_loans = compact(replay_engine.replay(transactions, ends, replay_engine.CreditBuildingPolicy(loans), periods, cohort))
+    curr_loans = merge_ever_accessed(curr_loans, ever)
+    if prev is not None:
+        curr_loans = pd.concat([prev, curr_loans], ignore_index=True)
+    final = classify(order_snapshots(curr_loans))
+    if since is not None:
+        final = final[final.snapshot >= pd.Timestamp(since)]
+    return final
+
+def compare_queries(end):
+    # Runs the join and the window variant of the period query for one snapshot and prints what each costs
+    report = RunReport('compare_queries')
+    backend.on_query = report.query
+    keys = ['user_reference', 'account_identifier']
+    results = {}
+    for name, window in [('join', False), ('window', True)]:
+        with report.span(name) as span:
+            results[name] = backend.read(period_query(periods[0].strftime('%Y-%m-%d'), end, window))
+            results[name] = results[name].sort_values(keys).reset_index(drop=True)
+            span['rows_out'] = len(results[name])
+    print(report.summary())
+    print("Same result: " + str(results['join'].equals(results['window'])))
+
+def write_status_index(args, read, report):
+    # Point-in-time status of every user up to the horizon (see status_index.py), from the daily state of the
+    # replay if this run made one, otherwise (sql engine, sharded or nothing to do) the transactions are replayed here
+    prepare_base(report)
+    with report.span('status_index') as span:
+        query = replay_engine.transactions_query(replay_engine.CreditBuildingPolicy.codes, horizon.strftime('%Y-%m-%d'))
+        if daily is not None and daily[0] is read and daily[1] == query:
+            policy, state = daily[2:]
         else:
-            final_accessed['new_default'][ind] = '2. No'
-
-
-final_not_accessed = final[final.ever_accessed != 'Yes']
-
-# Sort
-final_not_accessed.sort_values(['user_reference', 'snapshot'], inplace = True)
-
-# reset index
-final_not_accessed.reset_index(drop=True, inplace=True)
-
-# add prev dlq bucket
-final_accessed['prev_status'] = '0. non existent'
-
-# add new loan flag
-final_accessed['new_loan'] = '0. No'
-
-final_not_accessed['prev_status'] = np.where(final_not_accessed['snapshot'] == final_not_accessed['cohort_end'], '0. non existent', '1. Current')
-
-final_not_accessed['new_loan'] = np.where(final_not_accessed['snapshot'] == final_not_accessed['cohort_end'], '1. Yes', '0. No')
-
-# Add new default flag
-final_not_accessed['new_default'] = '3. NA'
-
-# Remerge
-
-final = pd.concat([final_accessed, final_not_accessed], axis=0)
-
-# Sort
-final.sort_values(['user_reference', 'snapshot'], inplace = True)
-
-# reset index
-final.reset_index(drop=True, inplace=True)
-
-# output the results to a spreadsheet
-# final.to_csv(csv_out_name, index=False)
-
-
-# Upload data back to the cloud 
-pgbq.to_gbq(final, out_table, project_id, if_exists='replace')
\ No newline at end of file
+            policy = replay_engine.CreditBuildingPolicy()
+            state = replay_engine.daily_state(read(query, horizon), policy)
+        index = status_index.build(state, policy, horizon)
+        index.save(os.path.join(args.status_index, 'CBWeekly'))
+        span['rows_out'] = len(index)
+
+# Companion tables of pre-aggregated snapshots for the dashboards (--cubes, see cubes.py): the table suffix with the
+# dimensions next to the snapshot, and the flag values counted in every cell
+cube_tables = {'_roll_rates': ['prev_status', 'snapshot_status'],
+               '_vintages': ['cohort_end_month', 'cohort_end', 'snapshot_status']}
+cube_counts = {'new_loans': ('new_loan', '1. Yes'), 'new_defaults': ('new_default', '1. Yes')}
+
+def verify_aging(end):
+    # Works out the due dates and statuses of one snapshot locally (aging.py, as the replay engine does) from the
+    # inputs the period query uses and compares them with the ones of the query
+    sql = backend.read(aging_query(periods[0].strftime('%Y-%m-%d'), end))
+    policy = replay_engine.CreditBuildingPolicy()
+    repaid_last = sql['PrevWithdrawDate'].notnull().to_numpy()
+    due_day = aging.cb_due_day(pd.to_datetime(sql['last_TR']).to_numpy(), pd.to_datetime(sql['PrevWithdrawDate']).to_numpy(), repaid_last,
+                               sql['RepaymentAmount'].to_numpy(dtype='float64'), sql['Prev_OS'].to_numpy(dtype='float64'),
+                               policy.min_payment, policy.min_payment_rate, policy.term_days)
+    status = policy.status(sql['OS'].to_numpy(dtype='float64'), due_day, np.datetime64(end, 'D'))
+    same_due = due_day == pd.to_datetime(sql['due_date']).to_numpy().astype('datetime64[D]')
+    same_status = status == sql['status'].to_numpy()
+    print(str(same_due.sum()) + " out of " + str(len(sql)) + " due dates and " + str(same_status.sum()) + " statuses the same")
+    differ = sql.assign(local_due_date=due_day, local_status=status)[~(same_due & same_status)]
+    if len(differ):
+        print(differ.head(20).to_string())
+    return len(differ) == 0
+
+def add_arguments(parser):
+    parser.add_argument('--verify-aging', metavar='YYYY-MM-DD', default=None,
+                        help='only compare the local due dates and statuses (aging.py) with the ones of the period query for this snapshot')
+    parser.add_argument('--window-query', action='store_true',
+                        help='build the period query with window functions instead of the withdrawal self-join')
+    parser.add_argument('--compare-queries', metavar='YYYY-MM-DD', default=None,
+                        help='only run both variants of the period query for this snapshot and compare their cost')
+
+# Columns that are derived locally and therefore not part of a freshly fetched snapshot
+derived_columns = ['prev_status', 'new_loan', 'new_default']
+
+def recompute_changed(args, report, since, fingerprints):
+    # Users whose transactions changed in the weeks before since, e.g. late-arriving transactions (see change_detection.py)
+    previous = change_detection.load_fingerprints(change_detection.fingerprint_path(args.upload_dir, out_table))
+    if previous is None:
+        return
+    changed = change_detection.changed_weeks(previous, fingerprints, before=since)
+    if changed.empty:
+        return
+
+    first = changed.min()
+    ends = [p for p in periods[1:] if first <= p < pd.Timestamp(since)]
+    if not ends:
+        # the changes fall in the period ending on since (e.g. the last month of the monthly view), which this run recomputes
+        return
+    users = list(changed.index)
+    print(str(len(users)) + " users with changed transactions since " + first.strftime('%Y-%m-%d') + ", recomputing their snapshots")
+
+    with report.span('changed_users') as span:
+        # read_query rather than the cached read, cached results may be the ones that changed
+        curr_loans = add_ever_accessed(replay_periods(ends, args, read_query, users=users), read_query)
+
+        prev_snapshot = incremental.last_stored_snapshot(out_table, backend, before=first.strftime('%Y-%m-%d'))
+        if prev_snapshot is not None:
+            prev = convert_dates(incremental.read_stored_snapshot(out_table, backend, prev_snapshot, exclude=derived_columns))
+            curr_loans = pd.concat([prev[prev['user_reference'].isin(users)], curr_loans], ignore_index=True)
+
+        final = classify(order_snapshots(curr_loans))
+        final = final[final.snapshot >= first].reset_index(drop=True)
+        uploader.patch_rows(final, out_table, backend, users, first.strftime('%Y-%m-%d'), ends[-1].strftime('%Y-%m-%d'),
+                            upload_dir=args.upload_dir)
+        span['rows_out'] = len(final)
+
+    if args.cubes:
+        with report.span('cubes'):
+            cubes.refresh(out_table, cube_tables, cube_counts, backend, first.strftime('%Y-%m-%d'), ends[-1].strftime('%Y-%m-%d'),
+                          upload_dir=args.upload_dir)
+
+def compute(ends, args, read, since, progress, report):
+    fetch_periods = replay_periods if args.engine == 'replay' else stack_periods
+
+    with report.span('fetch') as span:
+        curr_loans = fetch_periods(ends, args, read, progress)
+        span['rows_out'] = len(curr_loans)
+
+    with report.span('ever_accessed', len(curr_loans)) as span:
+        curr_loans = add_ever_accessed(curr_loans, read)
+        span['rows_out'] = len(curr_loans)
+
+    if since is not None:
+        # The stored snapshot just before the recomputed weeks is stacked in front of them so that prev_status can be calculated
+        with report.span('previous') as span:
+            prev_snapshot = incremental.last_stored_snapshot(out_table, backend, before=since)
+            if prev_snapshot is not None:
+                prev = convert_dates(incremental.read_stored_snapshot(out_table, backend, prev_snapshot, exclude=derived_columns))
+                curr_loans = pd.concat([prev, curr_loans], ignore_index=True)
+            span['rows_out'] = len(curr_loans)
+
+    with report.span('transitions', len(curr_loans)) as span:
+        final = order_snapshots(curr_loans)
+        span['rows_out'] = len(final)
+
+    with report.span('classification', len(final)) as span:
+        final = classify(final)
+        if since is not None:
+            final = final[final.snapshot >= pd.Timestamp(since)].reset_index(drop=True)
+        span['rows_out'] = len(final)
+
+    return final
+
+def compute_sharded(ends, args, read, since, report):
+    # Same rows as compute with the replay engine, the users are split into args.shards shards that are
+    # replayed and classified in worker processes (see sharding.py)
+    with report.span('fetch') as span:
+        loans = read(replay_engine.loans_query())
+        query = replay_engine.transactions_query(replay_engine.CreditBuildingPolicy.codes, max(ends).strftime('%Y-%m-%d'))
+        sharded = {'transactions': read(query, max(ends)), 'ever': read(ever_query)}
+        span['rows_out'] = len(sharded['transactions'])
+
+    if since is not None:
+        with report.span('previous') as span:
+            prev_snapshot = incremental.last_stored_snapshot(out_table, backend, before=since)
+            if prev_snapshot is not None:
+                sharded['prev'] = convert_dates(incremental.read_stored_snapshot(out_table, backend, prev_snapshot, exclude=derived_columns))
+                span['rows_out'] = len(sharded['prev'])
+
+    with report.span('sharded', len(sharded['transactions'])) as span:
+        final = sharding.run(process_shard, sharded, {'loans': loans}, shards=args.shards, workers=args.shard_workers,
+                             ends=list(ends), since=since, view=view, grid=list(periods), table=out_table)
+        # in the order of the unsharded run, so that the partition fingerprints of the upload match
+        final = final.sort_values(['user_reference', 'snapshot'], kind='mergesort').reset_index(drop=True)
+        span['rows_out'] = len(final)
+
+    return final
+
+# Pre-flight estimate of the run and budget guard (see preflight.py), set by main with --dry-run or --budget-gb
+guard = None
+
+# Scratch base tables of the run (--base-tables), set by main and materialised after the pre-flight check
+base = None
+
+def prepare_base(report):
+    # Materialises the base tables on first use, i.e. only once a run goes ahead
+    if base is not None and not base.prepared:
+        with report.span('base_tables'):
+            base.prepare(execute, replay_engine.CreditBuildingPolicy.codes)
+
+def planned_queries(ends, args):
+    # The queries of a run over ends as (label, sql, period_end), for the pre-flight estimate: the base tables
+    # if they are still to be materialised, and the queries as on the source tables (with --base-tables they
+    # read the scratch tables instead, i.e. they scan less than estimated)
+    queries = []
+    if base is not None and not base.prepared:
+        queries += [('base table ' + table, statement, None)
+                    for table, statement in zip([base.mapping, base.transactions], base.statements(replay_engine.CreditBuildingPolicy.codes))]
+    if args.detect_changes:
+        queries.append(('fingerprints', change_detection.fingerprint_query(replay_engine.CreditBuildingPolicy.codes, str(curr_week_end)), None))
+    if args.engine == 'replay':
+        end = max(ends) if args.shards > 1 or horizon is None else max(max(ends), horizon)
+        query = replay_engine.transactions_query(replay_engine.CreditBuildingPolicy.codes, end.strftime('%Y-%m-%d'))
+        if daily is not None and daily[1] == query and args.shards <= 1:
+            # the daily state of the previous view is used again
+            return queries + [('ever_accessed', ever_query, None)]
+        queries.append(('transactions', query, end))
+        queries.append(('loans', replay_engine.loans_query(), None))
+    else:
+        start = periods[0].strftime('%Y-%m-%d')
+        queries += [('period ' + end.strftime('%Y-%m-%d'), period_query(start, end.strftime('%Y-%m-%d'), args.window_query), end)
+                    for end in ends]
+    queries.append(('ever_accessed', ever_query, None))
+    return queries
+
+def check_budget(args, since, ends, report):
+    # Estimates the run over ends. A rebuild over the budget falls back to an incremental run from the last stored
+    # snapshot. Returns the since and ends to run with, None if the run does not go ahead (dry run, nothing to do)
+    with report.span('preflight') as span:
+        estimate = guard.estimate(planned_queries(ends, args))
+        print(guard.summary(estimate, 'CBWeekly ' + view))
+        if not guard.within(estimate) and since is None and not args.dry_run:
+            since = incremental.resume_point(out_table, backend)
+            if since is not None:
+                print("Over budget, falling back to an incremental run from " + since)
+                ends = incremental.pending_periods(periods[1:], since, curr_week_end)
+                estimate = guard.estimate(planned_queries(ends, args))
+                print(guard.summary(estimate, 'CBWeekly ' + view))
+        span['rows_out'] = len(estimate)
+
+    if args.dry_run:
+        return None
+    if not guard.within(estimate):
+        raise SystemExit(guard.refusal(estimate))
+    if not ends:
+        print("Nothing to do, no period ends on or after " + since)
+        return None
+    return since, ends
+
+def update(args, read, report):
+    since = None
+    if not args.rebuild:
+        with report.span('resume'):
+            since = incremental.resume_point(out_table, backend, args.since)
+
+    if since is None:
+        # Full regeneration. The first period end is only used as the start of the cohort ends
+        ends = [periods[periods.size-1]] + list(periods[1:periods.size-1])
+    else:
+        ends = incremental.pending_periods(periods[1:], since, curr_week_end)
+        if not ends:
+            print("Nothing to do, no period ends on or after " + since)
+            return
+
+    if guard is not None:
+        checked = check_budget(args, since, ends, report)
+        if checked is None:
+            return
+        since, ends = checked
+    prepare_base(report)
+
+    progress = checkpoint.from_options(args, 'CBWeekly' if view == 'weekly' else 'CBWeekly_' + view, ends)
+
+    if args.detect_changes:
+        # taken before the transactions are read, anything arriving during the run shows up as a change next time
+        with report.span('fingerprints') as span:
+            fingerprints = change_detection.read_fingerprints(read_query, replay_engine.CreditBuildingPolicy.codes, str(curr_week_end))
+            span['rows_out'] = len(fingerprints)
+
+    if args.shards > 1 and args.engine == 'replay':
+        final = compute_sharded(ends, args, read, since, report)
+    else:
+        if args.shards > 1:
+            print("--shards needs --engine replay, running unsharded")
+        final = compute(ends, args, read, since, progress, report)
+
+    # output the results to a spreadsheet
+    # final.to_csv(csv_out_name, index=False)
+
+    with report.span('upload', len(final)):
+        # Upload data back to the cloud, replacing the snapshot partitions that changed
+        uploader.upload(final, out_table, backend, since, upload_dir=args.upload_dir)
+
+    if args.cubes:
+        with report.span('cubes', len(final)) as span:
+            span['rows_out'] = cubes.update(final, out_table, cube_tables, cube_counts, backend, since, upload_dir=args.upload_dir)
+
+    if args.detect_changes:
+        if since is not None:
+            recompute_changed(args, report, since, fingerprints)
+        change_detection.save_fingerprints(change_detection.fingerprint_path(args.upload_dir, out_table), fingerprints)
+
+    if progress is not None:
+        progress.clear()
+
+def main(argv=None):
+    global backend, horizon, guard, base
+    args = parse_run_args('Week over week view for the Credit Building portfolio', argv, add_arguments)
+
+    backend = backends.from_options(args, project_id)
+
+    if args.compare_queries is not None:
+        compare_queries(args.compare_queries)
+        return
+    if args.verify_aging is not None:
+        if not verify_aging(args.verify_aging):
+            raise SystemExit(1)
+        return
+
+    if args.views != ['weekly'] and args.engine != 'replay':
+        raise SystemExit("Only the weekly view can be computed with --engine sql")
+    # the transactions are replayed once, up to the last period end of all the views
+    horizon = max(max(pd.to_datetime(args.period_ends)) if name == 'custom' else views[name][0][-1] for name in args.views)
+
+    report = RunReport('CBWeekly')
+    backend.on_query = report.query
+
+    # Queries read from the base tables (if materialised) through the local cache (if configured)
+    read = read_query
+    base = None
+    if args.base_tables:
+        # materialised by prepare_base once the run goes ahead
+        base = BaseTables(args.scratch_dataset, 'cb')
+        read = base.wrap(read)
+
+    # Weeks before the last completed one can be pinned in the cache
+    cache = query_cache.from_options(args, pin_before=curr_week_end - datetime.timedelta(days=7))
+    if cache is not None:
+        read = cache.wrap(read)
+    guard = preflight.from_options(args, backend, cache)
+
+    try:
+        for name in args.views:
+            select_view(name, args.period_ends, args.custom_table)
+            if len(args.views) > 1:
+                print("View " + name + ": " + out_table)
+            update(args, read, report)
+        if args.status_index is not None and not args.dry_run:
+            write_status_index(args, read, report)
+    finally:
+        if base is not None and base.prepared:
+            base.drop(execute)
+        print(report.summary())
+        if args.report is not None:
+            report.write(args.report)
+
+if __name__ == '__main__':
+    main()
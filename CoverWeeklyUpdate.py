@@ -2,21 +2,47 @@
 
 # Revision: Aug 21, 2022
 
-# This version of the script regenerates the whole file from scratch.
-# Use this version of the script if some data issues have been identified (after the issues have been fixed)
+# By default the script runs incrementally: it reads the last snapshot stored in the output table,
+# computes only the new week(s) and appends them.
+# Run with --rebuild to regenerate the whole file from scratch.
+# Use --rebuild if some data issues have been identified (after the issues have been fixed)
 # in the underlying feeder files
 #
 #
 # This version of the script includes "do not collect" logic wherein a user
 # remains current if they make the $5 fee payment every month
+#
+# OS is rounded to cents (the replay engine does the same). Before, the floating point residue of a fully
+# repaid balance (e.g. 1.4e-14) was stored as is and made the user '2. current' to '6. 91+' or
+# '7. Balance Issue' instead of '1. Inactive', which also moved prev_status, paid_class, new_default and
+# paid_in_cohort. Snapshots stored before the change keep the old values until the next --rebuild.
 
 import pandas as pd
-import pandas_gbq as pgbq
 from time import strftime
 import datetime
+import os
 import numpy as np
 
-from google.oauth2 import service_account
+import backends
+import fetch_pool
+import change_detection
+import checkpoint
+import cubes
+import incremental
+import preflight
+import query_cache
+import replay_engine
+import sharding
+import status_index
+from base_tables import BaseTables
+import rules
+import snapshot_lookup
+import uploader
+from frame_collector import FrameCollector, compact, convert_dates
+from run_options import parse_run_args
+from run_report import RunReport
+
+#from google.oauth2 import service_account
 #credentials = service_account.Credentials.from_service_account_file(
 #    './tensile-oarlock-191715-7c8e26b6cf77.json')
 
@@ -34,7 +60,7 @@ csv_out_name = 'coverme_finance_weekly_view_2022_10_31_mst_2.csv'
 
 # This is the output table that we write to in MetaBase
 # Do not modify this
-out_table = 'risk.CM_finance_weekly_view_alt'
+out_table = 'risk.CM_finance_weekly_view_new'
 
 # Cohort ends
 # Do not modify the start date
@@ -50,13 +76,35 @@ periods = pd.date_range(start='2021-07-31',
                        freq='W') # W for weekly M for monthly
 periods
 
-def loans_by_period(start, end):
+# The views that can be derived from the same daily state of the replay engine (--views, see select_view):
+# period grid, output table and cohort of each. The first period end of a grid only opens the first period.
+# A custom view takes its period ends and output table from the command line
+views = {'weekly': (periods, out_table, replay_engine.week_end),
+         'monthly': (pd.date_range(start='2021-07-31', end=str(last_day), freq=pd.offsets.MonthEnd()),
+                     'risk.CM_finance_monthly_view_new', replay_engine.month_end)}
+view = 'weekly'
+cohort = replay_engine.week_end
+
+# The in period flow columns are named after the period of the view
+flow_periods = {'weekly': 'week', 'monthly': 'month', 'custom': 'period'}
+
+# The data source, BigQuery unless another backend is chosen on the command line (see backends.py)
+backend = backends.BigQueryBackend(project_id)
+
+def read_query(query, period_end=None):
+    return backend.read(query)
+
+def execute(statement):
+    # Runs a statement that returns no rows (DDL / DML)
+    backend.execute(statement)
+
+def period_query(start, end):
     
     # Quite a few variables have "month" in their name. Going through and changing to "week"
     # would be a pain in the ass so leaving as "month" for now.
     # For example, repayments_in_month only captures the repayments made in the last week
     
-    query = """with
+    return """with
     
                 mapping as (select 
                                 distinct account_group_identifier, 
@@ -116,7 +164,8 @@ def loans_by_period(start, end):
                 OS as 
                     (select 
                         distinct a.user_reference, 
-                        sum(a.Amount) as OS 
+                        -- amounts are in cents, rounding drops the floating point residue of a fully repaid balance
+                        round(sum(a.Amount), 2) as OS 
                     from transactions as a 
                     inner join first_loan as b 
                         on a.user_reference = b.user_reference 
@@ -214,126 +263,435 @@ select *, case when user_reference in (select string_field_0 from credit.ep_migr
   
 """.format(start, end)
 
-    loans = pgbq.read_gbq(query, project_id, dialect='standard')
+def loans_by_period(start, end, read=read_query):
+
+    loans = read(period_query(start, end), end)
     
     return loans
 
-# initializing curr_loans
-curr_loans = loans_by_period(periods[0].strftime('%Y-%m-%d'),periods[periods.size-1].strftime('%Y-%m-%d'))
-
-curr_loans.head()
-
-# creating stacked dataset
-i = 1
-while i < periods.size-1:
-    curr_loans = pd.concat([curr_loans, loans_by_period(periods[0].strftime('%Y-%m-%d'),periods[i].strftime('%Y-%m-%d'))], ignore_index=True)
-    i += 1
-    print( str(i) + " out of " + str(periods.size-1))
-
-# output the results to a spreadsheet
-curr_month_end = datetime.datetime.strptime(curr_month_end, '%Y-%m-%d')
-
-for i in range(len(curr_loans.columns)):
-    if(curr_loans.dtypes.values[i] == "dbdate"):
-        curr_loans[curr_loans.columns[i]]= pd.to_datetime(curr_loans[curr_loans.columns[i]])
-
-# Delete snapshots that are greater than the current month
-curr_loans = curr_loans[curr_loans.snapshot <= curr_month_end]
-curr_loans = curr_loans.drop_duplicates()
-# curr_loans.to_csv('new_pay_logic_test_2.csv', index=False)
-
-# curr_loans.to_csv('new_weekly_pay_logic_test.csv', index=False)
-
-curr_loans['snapshot_status'].value_counts()
-
-curr_loans['days_between_paid_and_due'] = ((curr_loans['update_date'] - curr_loans['due_date'])/np.timedelta64(1,'D')).astype(int)
-
-# Self Merge to get previous status
-
-curr_loans_copy = curr_loans[['snapshot', 'user_reference', 'snapshot_status']]
-curr_loans = curr_loans.merge(curr_loans_copy, how='left', left_on=["user_reference", "prev_snap"], right_on=["user_reference","snapshot"], suffixes=('_left', '_right'))
-curr_loans.drop(['snapshot_right'],axis=1,inplace=True)
-curr_loans = curr_loans.rename({'snapshot_left': 'snapshot', 'snapshot_status_left': 'snapshot_status','snapshot_status_right' :  'prev_status'}, axis='columns')
-curr_loans['prev_status'].fillna('0. non existent', inplace = True)
-curr_loans.head()
-
-curr_loans_2 = curr_loans.copy(deep=True)
-
-def get_new(row):
-    if row['snapshot'] == row['cohort_end']:
-        return 'Yes'
+def stack_periods(ends, options, read=read_query, progress=None):
+    # fetch the periods concurrently and stack them in the order of ends
+    # periods recorded in the checkpoint (progress) by a previous failed run are not fetched again
+    start = periods[0].strftime('%Y-%m-%d')
+    collector = FrameCollector(options.memory_budget, options.spill_dir)
+
+    pending = list(range(len(ends)))
+    if progress is not None:
+        for position, path in progress.completed().items():
+            collector.add_file(path, position)
+        pending = progress.pending(len(ends))
+        if len(ends) > len(pending):
+            print("Resuming, " + str(len(ends) - len(pending)) + " out of " + str(len(ends)) + " periods already fetched")
+
+    def on_result(frame, i):
+        position = pending[i]
+        if progress is not None:
+            frame = progress.record(frame, position, ends[position])
+        collector.add(frame, position)
+
+    fetch_pool.fetch_all([ends[i] for i in pending], lambda end: loans_by_period(start, end.strftime('%Y-%m-%d'), read),
+                         workers=options.workers, retries=options.retries, backoff=options.backoff,
+                         on_result=on_result)
+    return collector.result()
+
+# The transactions are replayed up to this date if it is later than the last period end (set by main to the
+# last period end of all the views of the run). The daily state of the last replay is kept for the next view
+# reading through the same read
+horizon = None
+daily = None
+
+def select_view(name, grid=None, table=None):
+    # Makes the functions below work on the period grid and output table of a view
+    global view, periods, out_table, cohort
+    if name == 'custom':
+        periods, out_table, cohort = pd.DatetimeIndex(sorted(pd.to_datetime(grid))), table, replay_engine.grid_cohort(grid)
     else:
-        return 'No'
-
-def get_paid_class(row):
-    if row['snapshot_status'] == '1. Inactive':
-        if row['days_between_paid_and_due'] <= 0:
-            return '1. paid on time'
-        elif 0 < row['days_between_paid_and_due'] < 91:
-            return '2. paid late'
-        elif row['prev_status'] == '6. 91+':
-            return '3. paid after default'
-        else:
-            return '2. paid late'
-    else: 
-        return '4. NA'
-
-def get_default(row):
-    if row['snapshot_status'] == '6. 91+':
-        if row['prev_status'] != '6. 91+':
-            return '1. Yes'
+        periods, out_table, cohort = views[name]
+    view = name
+
+def replay_periods(ends, options, read=read_query, progress=None, users=None):
+    # Same rows as stack_periods, from a single pull of the ODR transactions (see replay_engine.py)
+    global daily
+    end = max(ends) if horizon is None else max(max(ends), horizon)
+    query = replay_engine.transactions_query(replay_engine.CoverPolicy.codes, end.strftime('%Y-%m-%d'), users)
+    if users is not None or daily is None or daily[0] is not read or daily[1] != query:
+        grad = read(replay_engine.grad_query)
+        migration = read(replay_engine.migration_query)
+        policy = replay_engine.CoverPolicy(grad['user_reference'], migration['user_reference'])
+        transactions = read(query, end)
+        state = replay_engine.daily_state(transactions, policy)
+        if users is not None:
+            return compact(replay_engine.resample(state, ends, policy, periods, cohort))
+        daily = (read, query, policy, state)
+    policy, state = daily[2:]
+    return compact(replay_engine.resample(state, ends, policy, periods, cohort))
+
+# Classification columns, each rule is (condition, label) in priority order (see rules.py)
+status_rules = {
+    'new_loan': ([(lambda d: d['snapshot'] == d['cohort_end'], 'Yes')],
+                 'No'),
+    'paid_class': ([(lambda d: (d['snapshot_status'] == '1. Inactive') & (d['days_between_paid_and_due'] <= 0), '1. paid on time'),
+                    (lambda d: (d['snapshot_status'] == '1. Inactive') & (d['days_between_paid_and_due'] > 0) & (d['days_between_paid_and_due'] < 91), '2. paid late'),
+                    (lambda d: (d['snapshot_status'] == '1. Inactive') & (d['prev_status'] == '6. 91+'), '3. paid after default'),
+                    (lambda d: d['snapshot_status'] == '1. Inactive', '2. paid late')],
+                   '4. NA'),
+    'new_default': ([(lambda d: (d['snapshot_status'] == '6. 91+') & (d['prev_status'] != '6. 91+'), '1. Yes'),
+                     (lambda d: d['snapshot_status'] == '6. 91+', '2. No')],
+                    '3. NA'),
+    'paid_in_cohort': ([(lambda d: (d['snapshot_status'] == '1. Inactive') & (d['cohort_paid'] == d['snapshot']), '1. Yes'),
+                        (lambda d: d['snapshot_status'] == '1. Inactive', '2. No')],
+                       '3. NA'),
+}
+
+def add_prev_status(curr_loans, prev=None):
+    # prev holds the stored snapshot just before the first week in curr_loans (incremental mode only)
+
+    curr_end = datetime.datetime.strptime(curr_month_end, '%Y-%m-%d')
+
+    # Delete snapshots that are greater than the current month
+    curr_loans = curr_loans[curr_loans.snapshot <= curr_end]
+    curr_loans = curr_loans.drop_duplicates()
+    # curr_loans.to_csv('new_pay_logic_test_2.csv', index=False)
+
+    # curr_loans.to_csv('new_weekly_pay_logic_test.csv', index=False)
+
+    curr_loans['days_between_paid_and_due'] = ((curr_loans['update_date'] - curr_loans['due_date'])/np.timedelta64(1,'D')).astype(int)
+
+    # Previous status: the status of the same user on the previous weekly snapshot (prev_snap)
+    curr_loans = curr_loans.sort_values(['user_reference', 'snapshot'], kind='mergesort').reset_index(drop=True)
+    if prev is not None:
+        prev = convert_dates(prev[['snapshot', 'user_reference', 'snapshot_status']].copy())
+    curr_loans['prev_status'] = snapshot_lookup.previous_values(curr_loans, 'user_reference', 'snapshot_status', expected='prev_snap',
+                                                                earlier=prev, missing='0. non existent')
+
+    return curr_loans
+
+def classify(curr_loans):
+    # curr_loans comes from add_prev_status: current weeks only, no duplicates, sorted by user and snapshot
+    final = rules.evaluate(curr_loans, status_rules)
+
+    # drop columns
+    # final.drop(labels=['loan_type','status','prev_snap','days_between_curr_and_dep','days_between_paid_and_due','days_between_curr_and_paid','days_between_curr_and_due'],axis=1, inplace=True)
+    final.drop(labels=['days_between_paid_and_due'],axis=1, inplace=True)
+
+    # delete extra paid status rows
+    # final.drop(final[(final.snapshot_status == '6. paid') and (final.snapshot_status == final.snapshot_status)].index, inplace=True)
+
+    # renaming columns
+    flow_period = flow_periods[view]
+    final.rename(columns={"num_loans_in_month": "num_loans_in_" + flow_period, "total_loaned_in_month": "total_loaned_in_" + flow_period, "num_repayments_in_month":"num_repayments_in_" + flow_period,"total_repaid_in_month":"total_repaid_in_" + flow_period},inplace=True)
+
+    return final
+
+def add_transitions(curr_loans, prev=None):
+    return classify(add_prev_status(curr_loans, prev))
+
+def process_shard(transactions, grad, migration, ends, prev=None, since=None, view='weekly', grid=None, table=None):
+    # One shard of users end to end in a worker process (see sharding.py)
+    select_view(view, grid, table)
+    policy = replay_engine.CoverPolicy(grad['user_reference'], migration['user_reference'])
+    curr_loans = compact(replay_engine.replay(transactions, ends, policy, periods, cohort))
+    final_dedup = classify(add_prev_status(curr_loans, prev))
+    if since is not None:
+        final_dedup = final_dedup[final_dedup.snapshot >= pd.Timestamp(since)]
+    return final_dedup
+
+def write_status_index(args, read, report):
+    # Point-in-time status of every user up to the horizon (see status_index.py), from the daily state of the
+    # replay if this run made one, otherwise (sql engine, sharded or nothing to do) the transactions are replayed here
+    prepare_base(report)
+    with report.span('status_index') as span:
+        query = replay_engine.transactions_query(replay_engine.CoverPolicy.codes, horizon.strftime('%Y-%m-%d'))
+        if daily is not None and daily[0] is read and daily[1] == query:
+            policy, state = daily[2:]
         else:
-            return '2. No'
+            policy = replay_engine.CoverPolicy()
+            state = replay_engine.daily_state(read(query, horizon), policy)
+        index = status_index.build(state, policy, horizon)
+        index.save(os.path.join(args.status_index, 'CoverWeeklyUpdate'))
+        span['rows_out'] = len(index)
+
+# Companion tables of pre-aggregated snapshots for the dashboards (--cubes, see cubes.py): the table suffix with the
+# dimensions next to the snapshot, and the flag values counted in every cell
+cube_tables = {'_roll_rates': ['prev_status', 'snapshot_status'],
+               '_vintages': ['cohort_end', 'snapshot_status']}
+cube_counts = {'new_loans': ('new_loan', 'Yes'), 'new_defaults': ('new_default', '1. Yes'),
+               'paid_on_time': ('paid_class', '1. paid on time'), 'paid_late': ('paid_class', '2. paid late'),
+               'paid_after_default': ('paid_class', '3. paid after default'), 'paid_in_cohort': ('paid_in_cohort', '1. Yes')}
+
+def verify_aging(end):
+    # Works out the due dates and statuses of one snapshot locally (aging.py, as the replay engine does) from the
+    # columns of the period query and compares them with the ones of the query
+    sql = convert_dates(loans_by_period(periods[0].strftime('%Y-%m-%d'), end))
+    policy = replay_engine.CoverPolicy()
+    day = np.datetime64(end, 'D')
+    expected, due_day = policy.due_date(pd.to_datetime(sql['last_loan_date']).to_numpy(), pd.to_datetime(sql['last_fee_date']).to_numpy(),
+                                        sql['num_fee_payments'].to_numpy(dtype='int64'), day)
+    status = policy.status(sql['OS'].to_numpy(dtype='float64'), due_day, day)
+    same_due = (due_day == pd.to_datetime(sql['due_date']).to_numpy().astype('datetime64[D]')) & (expected == sql['num_expected_fee_payments'].to_numpy())
+    same_status = status == sql['snapshot_status'].to_numpy()
+    print(str(same_due.sum()) + " out of " + str(len(sql)) + " due dates and " + str(same_status.sum()) + " statuses the same")
+    differ = sql.assign(local_expected=expected, local_due_date=due_day, local_status=status)[~(same_due & same_status)]
+    if len(differ):
+        print(differ.head(20).to_string())
+    return len(differ) == 0
+
+def add_arguments(parser):
+    parser.add_argument('--csv', action='store_true',
+                        help='also write the uploaded rows to csv_out_name')
+    parser.add_argument('--verify-aging', metavar='YYYY-MM-DD', default=None,
+                        help='only compare the local due dates and statuses (aging.py) with the ones of the period query for this snapshot')
+
+def recompute_changed(args, report, since, fingerprints):
+    # Users whose transactions changed in the weeks before since, e.g. late-arriving transactions (see change_detection.py)
+    previous = change_detection.load_fingerprints(change_detection.fingerprint_path(args.upload_dir, out_table))
+    if previous is None:
+        return
+    changed = change_detection.changed_weeks(previous, fingerprints, before=since)
+    if changed.empty:
+        return
+
+    first = changed.min()
+    ends = [p for p in periods[1:] if first <= p < pd.Timestamp(since)]
+    if not ends:
+        # the changes fall in the period ending on since (e.g. the last month of the monthly view), which this run recomputes
+        return
+    users = list(changed.index)
+    print(str(len(users)) + " users with changed transactions since " + first.strftime('%Y-%m-%d') + ", recomputing their snapshots")
+
+    with report.span('changed_users') as span:
+        prev = None
+        prev_snapshot = incremental.last_stored_snapshot(out_table, backend, before=first.strftime('%Y-%m-%d'))
+        if prev_snapshot is not None:
+            prev = incremental.read_stored_snapshot(out_table, backend, prev_snapshot, columns=['snapshot', 'user_reference', 'snapshot_status'])
+
+        # read_query rather than the cached read, cached results may be the ones that changed
+        final_dedup = classify(add_prev_status(replay_periods(ends, args, read_query, users=users), prev))
+        uploader.patch_rows(final_dedup, out_table, backend, users, first.strftime('%Y-%m-%d'), ends[-1].strftime('%Y-%m-%d'),
+                            upload_dir=args.upload_dir)
+        span['rows_out'] = len(final_dedup)
+
+    if args.cubes:
+        with report.span('cubes'):
+            cubes.refresh(out_table, cube_tables, cube_counts, backend, first.strftime('%Y-%m-%d'), ends[-1].strftime('%Y-%m-%d'),
+                          upload_dir=args.upload_dir)
+
+def compute(ends, args, read, since, progress, report):
+    fetch_periods = replay_periods if args.engine == 'replay' else stack_periods
+
+    # The stored snapshot just before the recomputed weeks is needed for prev_status
+    prev = None
+    if since is not None:
+        with report.span('previous') as span:
+            prev_snapshot = incremental.last_stored_snapshot(out_table, backend, before=since)
+            if prev_snapshot is not None:
+                prev = incremental.read_stored_snapshot(out_table, backend, prev_snapshot, columns=['snapshot', 'user_reference', 'snapshot_status'])
+                span['rows_out'] = len(prev)
+
+    with report.span('fetch') as span:
+        curr_loans = fetch_periods(ends, args, read, progress)
+        span['rows_out'] = len(curr_loans)
+
+    with report.span('transitions', len(curr_loans)) as span:
+        curr_loans = add_prev_status(curr_loans, prev)
+        span['rows_out'] = len(curr_loans)
+
+    with report.span('classification', len(curr_loans)) as span:
+        final_dedup = classify(curr_loans)
+        if since is not None:
+            final_dedup = final_dedup[final_dedup.snapshot >= pd.Timestamp(since)].reset_index(drop=True)
+        span['rows_out'] = len(final_dedup)
+
+    return final_dedup
+
+def compute_sharded(ends, args, read, since, report):
+    # Same rows as compute with the replay engine, the users are split into args.shards shards that are
+    # replayed and classified in worker processes (see sharding.py)
+    with report.span('fetch') as span:
+        shared = {'grad': read(replay_engine.grad_query), 'migration': read(replay_engine.migration_query)}
+        query = replay_engine.transactions_query(replay_engine.CoverPolicy.codes, max(ends).strftime('%Y-%m-%d'))
+        sharded = {'transactions': read(query, max(ends))}
+        span['rows_out'] = len(sharded['transactions'])
+
+    if since is not None:
+        with report.span('previous') as span:
+            prev_snapshot = incremental.last_stored_snapshot(out_table, backend, before=since)
+            if prev_snapshot is not None:
+                sharded['prev'] = incremental.read_stored_snapshot(out_table, backend, prev_snapshot, columns=['snapshot', 'user_reference', 'snapshot_status'])
+                span['rows_out'] = len(sharded['prev'])
+
+    with report.span('sharded', len(sharded['transactions'])) as span:
+        final_dedup = sharding.run(process_shard, sharded, shared, shards=args.shards, workers=args.shard_workers,
+                                   ends=list(ends), since=since, view=view, grid=list(periods), table=out_table)
+        # in the order of the unsharded run, so that the partition fingerprints of the upload match
+        final_dedup = final_dedup.sort_values(['user_reference', 'snapshot'], kind='mergesort').reset_index(drop=True)
+        span['rows_out'] = len(final_dedup)
+
+    return final_dedup
+
+# Pre-flight estimate of the run and budget guard (see preflight.py), set by main with --dry-run or --budget-gb
+guard = None
+
+# Scratch base tables of the run (--base-tables), set by main and materialised after the pre-flight check
+base = None
+
+def prepare_base(report):
+    # Materialises the base tables on first use, i.e. only once a run goes ahead
+    if base is not None and not base.prepared:
+        with report.span('base_tables'):
+            base.prepare(execute, replay_engine.CoverPolicy.codes)
+
+def planned_queries(ends, args):
+    # The queries of a run over ends as (label, sql, period_end), for the pre-flight estimate: the base tables
+    # if they are still to be materialised, and the queries as on the source tables (with --base-tables they
+    # read the scratch tables instead, i.e. they scan less than estimated)
+    queries = []
+    if base is not None and not base.prepared:
+        queries += [('base table ' + table, statement, None)
+                    for table, statement in zip([base.mapping, base.transactions], base.statements(replay_engine.CoverPolicy.codes))]
+    if args.detect_changes:
+        queries.append(('fingerprints', change_detection.fingerprint_query(replay_engine.CoverPolicy.codes, curr_month_end), None))
+    if args.engine == 'replay':
+        end = max(ends) if args.shards > 1 or horizon is None else max(max(ends), horizon)
+        query = replay_engine.transactions_query(replay_engine.CoverPolicy.codes, end.strftime('%Y-%m-%d'))
+        if daily is not None and daily[1] == query and args.shards <= 1:
+            # the daily state of the previous view is used again
+            return queries
+        queries.append(('transactions', query, end))
+        queries += [('grad', replay_engine.grad_query, None), ('migration', replay_engine.migration_query, None)]
     else:
-        return '3. NA'
-
-def get_paid_cohort(row):
-    if row['snapshot_status'] == '1. Inactive':
-        if row['cohort_paid'] == row['snapshot']:
-            return '1. Yes'
-        else:
-            return '2. No'
+        start = periods[0].strftime('%Y-%m-%d')
+        queries += [('period ' + end.strftime('%Y-%m-%d'), period_query(start, end.strftime('%Y-%m-%d')), end) for end in ends]
+    return queries
+
+def check_budget(args, since, ends, report):
+    # Estimates the run over ends. A rebuild over the budget falls back to an incremental run from the last stored
+    # snapshot. Returns the since and ends to run with, None if the run does not go ahead (dry run, nothing to do)
+    with report.span('preflight') as span:
+        estimate = guard.estimate(planned_queries(ends, args))
+        print(guard.summary(estimate, 'CoverWeeklyUpdate ' + view))
+        if not guard.within(estimate) and since is None and not args.dry_run:
+            since = incremental.resume_point(out_table, backend)
+            if since is not None:
+                print("Over budget, falling back to an incremental run from " + since)
+                ends = incremental.pending_periods(periods[1:], since, curr_month_end)
+                estimate = guard.estimate(planned_queries(ends, args))
+                print(guard.summary(estimate, 'CoverWeeklyUpdate ' + view))
+        span['rows_out'] = len(estimate)
+
+    if args.dry_run:
+        return None
+    if not guard.within(estimate):
+        raise SystemExit(guard.refusal(estimate))
+    if not ends:
+        print("Nothing to do, no period ends on or after " + since)
+        return None
+    return since, ends
+
+def update(args, read, report):
+    since = None
+    if not args.rebuild:
+        with report.span('resume'):
+            since = incremental.resume_point(out_table, backend, args.since)
+
+    if since is None:
+        # Full regeneration. The first period end is only used as the start of the cohort ends
+        ends = [periods[periods.size-1]] + list(periods[1:periods.size-1])
     else:
-            return '3. NA'
-
-curr_loans_2['new_loan'] = curr_loans_2.apply(get_new, axis=1)
-curr_loans_2['paid_class'] = curr_loans_2.apply(get_paid_class, axis=1)
-curr_loans_2['new_default'] = curr_loans_2.apply(get_default, axis=1)
-curr_loans_2['paid_in_cohort'] = curr_loans_2.apply(get_paid_cohort, axis=1)
-curr_loans_2.head()
-
-for i in range(len(curr_loans_2.columns)):
-    if(curr_loans_2.dtypes.values[i] == "dbdate"):
-        curr_loans_2[curr_loans_2.columns[i]]= pd.to_datetime(curr_loans_2[curr_loans_2.columns[i]])
-
-# Delete snapshots that are greater than the current month
-final = curr_loans_2[curr_loans_2.snapshot <= curr_month_end]
-
-
-# Sort
-final.sort_values(['user_reference', 'snapshot'], inplace = True)        
-            
-# drop columns
-# final.drop(labels=['loan_type','status','prev_snap','days_between_curr_and_dep','days_between_paid_and_due','days_between_curr_and_paid','days_between_curr_and_due'],axis=1, inplace=True)
-final.drop(labels=['days_between_paid_and_due'],axis=1, inplace=True)
-
-# delete extra paid status rows
-# final.drop(final[(final.snapshot_status == '6. paid') and (final.snapshot_status == final.snapshot_status)].index, inplace=True)
-final_dedup = final.drop_duplicates()
-
-# reset index
-final_dedup.reset_index(drop=True, inplace=True)
-
-# renaming columns
-final_dedup.rename(columns={"num_loans_in_month": "num_loans_in_week", "total_loaned_in_month": "total_loaned_in_week", "num_repayments_in_month":"num_repayments_in_week","total_repaid_in_month":"total_repaid_in_week"},inplace=True)
-
-# output the results to a spreadsheet
-final_dedup.to_csv(csv_out_name, index=False)
-
-
-final_dedup.head()
-
-curr_loans_2.dtypes
-
-# Upload data back to the cloud 
-pgbq.to_gbq(final_dedup, 'risk.CM_finance_weekly_view_new', project_id, if_exists='replace')
\ No newline at end of file
+        ends = incremental.pending_periods(periods[1:], since, curr_month_end)
+        if not ends:
+            print("Nothing to do, no period ends on or after " + since)
+            return
+
+    if guard is not None:
+        checked = check_budget(args, since, ends, report)
+        if checked is None:
+            return
+        since, ends = checked
+    prepare_base(report)
+
+    progress = checkpoint.from_options(args, 'CoverWeeklyUpdate' if view == 'weekly' else 'CoverWeeklyUpdate_' + view, ends)
+
+    if args.detect_changes:
+        # taken before the transactions are read, anything arriving during the run shows up as a change next time
+        with report.span('fingerprints') as span:
+            fingerprints = change_detection.read_fingerprints(read_query, replay_engine.CoverPolicy.codes, curr_month_end)
+            span['rows_out'] = len(fingerprints)
+
+    if args.shards > 1 and args.engine == 'replay':
+        final_dedup = compute_sharded(ends, args, read, since, report)
+    else:
+        if args.shards > 1:
+            print("--shards needs --engine replay, running unsharded")
+        final_dedup = compute(ends, args, read, since, progress, report)
+
+    with report.span('upload', len(final_dedup)):
+        # output the results to a spreadsheet
+        if args.csv:
+            final_dedup.to_csv(csv_out_name, index=False)
+
+        # Upload data back to the cloud, replacing the snapshot partitions that changed
+        uploader.upload(final_dedup, out_table, backend, since, upload_dir=args.upload_dir)
+
+    if args.cubes:
+        with report.span('cubes', len(final_dedup)) as span:
+            span['rows_out'] = cubes.update(final_dedup, out_table, cube_tables, cube_counts, backend, since, upload_dir=args.upload_dir)
+
+    if args.detect_changes:
+        if since is not None:
+            recompute_changed(args, report, since, fingerprints)
+        change_detection.save_fingerprints(change_detection.fingerprint_path(args.upload_dir, out_table), fingerprints)
+
+    if progress is not None:
+        progress.clear()
+
+def main(argv=None):
+    global backend, horizon, guard, base
+    args = parse_run_args('Week over week view for the CoverMe portfolio', argv, add_arguments)
+
+    backend = backends.from_options(args, project_id)
+
+    if args.verify_aging is not None:
+        if not verify_aging(args.verify_aging):
+            raise SystemExit(1)
+        return
+
+    if args.views != ['weekly'] and args.engine != 'replay':
+        raise SystemExit("Only the weekly view can be computed with --engine sql")
+    # the transactions are replayed once, up to the last period end of all the views
+    horizon = max(max(pd.to_datetime(args.period_ends)) if name == 'custom' else views[name][0][-1] for name in args.views)
+
+    report = RunReport('CoverWeeklyUpdate')
+    backend.on_query = report.query
+
+    # Queries read from the base tables (if materialised) through the local cache (if configured)
+    read = read_query
+    base = None
+    if args.base_tables:
+        # materialised by prepare_base once the run goes ahead
+        base = BaseTables(args.scratch_dataset, 'cover')
+        read = base.wrap(read)
+
+    # Weeks before the last completed one can be pinned in the cache
+    cache = query_cache.from_options(args, pin_before=curr_month_end)
+    if cache is not None:
+        read = cache.wrap(read)
+    guard = preflight.from_options(args, backend, cache)
+
+    try:
+        for name in args.views:
+            select_view(name, args.period_ends, args.custom_table)
+            if len(args.views) > 1:
+                print("View " + name + ": " + out_table)
+            update(args, read, report)
+        if args.status_index is not None and not args.dry_run:
+            write_status_index(args, read, report)
+    finally:
+        if base is not None and base.prepared:
+            base.drop(execute)
+        print(report.summary())
+        if args.report is not None:
+            report.write(args.report)
+
+if __name__ == '__main__':
+    main()
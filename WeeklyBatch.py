@@ -0,0 +1,132 @@
+# This script runs the weekly views of both portfolios (CBWeekly.py and CoverWeeklyUpdate.py) as one batch
+
+# Both views are computed with the replay engine from a single pull of the CRB and ODR transactions
+# (see shared_transactions.py) instead of one pull per portfolio. The two portfolios are then processed and
+# uploaded in parallel, each to its own output table and with its own stage report.
+#
+# The options are the same as for the two scripts (--engine is always replay, the custom view is not
+# available as the two portfolios need different output tables), e.g.
+#   python WeeklyBatch.py
+#   python WeeklyBatch.py --rebuild --views weekly,monthly --report weekly
+# --report PREFIX writes PREFIX_WeeklyBatch, PREFIX_CBWeekly and PREFIX_CoverWeeklyUpdate .json / .csv
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import backends
+import preflight
+import CBWeekly
+import CoverWeeklyUpdate
+import query_cache
+import replay_engine
+from base_tables import BaseTables
+from run_options import parse_run_args
+from run_report import RunReport
+from shared_transactions import SharedTransactions
+
+project_id = 'tensile-oarlock-191715'
+
+# The portfolio scripts and the payment codes of their transactions
+portfolios = [(CBWeekly, replay_engine.CreditBuildingPolicy.codes),
+              (CoverWeeklyUpdate, replay_engine.CoverPolicy.codes)]
+
+# The data source, BigQuery unless another backend is chosen on the command line (see backends.py)
+backend = backends.BigQueryBackend(project_id)
+
+def read_query(query, period_end=None):
+    return backend.read(query)
+
+def execute(statement):
+    # Runs a statement that returns no rows (DDL / DML)
+    backend.execute(statement)
+
+def add_arguments(parser):
+    CoverWeeklyUpdate.add_arguments(parser)
+    parser.add_argument('--sequential', action='store_true',
+                        help='process the portfolios one after the other instead of in parallel')
+
+def main(argv=None):
+    global backend
+    args = parse_run_args('Week over week views of the Credit Building and CoverMe portfolios', argv, add_arguments)
+    args.engine = 'replay'
+    args.window_query = False
+    if 'custom' in args.views:
+        raise SystemExit("The custom view is only available in the portfolio scripts")
+    if args.verify_aging is not None:
+        raise SystemExit("--verify-aging is only available in the portfolio scripts")
+
+    # One backend for the batch, handed to both scripts
+    backend = backends.from_options(args, project_id)
+    for script, codes in portfolios:
+        script.backend = backend
+
+    # Queries are attributed to the report of the portfolio running them (the shared pull to the one that asks first),
+    # the base tables to the batch
+    report = RunReport('WeeklyBatch')
+    reports = [None] * len(portfolios)
+    current = threading.local()
+    backend.on_query = lambda stats: getattr(current, 'report', report).query(stats)
+
+    # Weeks before the last completed one can be pinned in the cache
+    cache = query_cache.from_options(args, pin_before=CoverWeeklyUpdate.curr_month_end)
+
+    # Each portfolio estimates its own queries against the budget (the shared pull scans less than the two
+    # transaction queries it stands in for), the shared base tables are estimated here before they are made
+    for script, codes in portfolios:
+        script.guard = preflight.from_options(args, backend, cache)
+
+    # Queries read from the base tables (if materialised) through the local cache (if configured)
+    read = read_query
+    base = None
+    if args.base_tables:
+        base = BaseTables(args.scratch_dataset, 'batch')
+        payment_codes = sorted(set(code for script, codes in portfolios for code in codes))
+        statements = base.statements(payment_codes)
+        guard = preflight.from_options(args, backend)
+        if guard is not None:
+            with report.span('preflight') as span:
+                estimate = guard.estimate(list(zip(['base table ' + base.mapping, 'base table ' + base.transactions], statements, [None, None])))
+                print(guard.summary(estimate, 'WeeklyBatch base tables'))
+                span['rows_out'] = len(estimate)
+            if not args.dry_run and not guard.within(estimate):
+                raise SystemExit(guard.refusal(estimate))
+        if not args.dry_run:
+            with report.span('base_tables'):
+                base.prepare(execute, payment_codes)
+        read = base.wrap(read)
+
+    if cache is not None:
+        read = cache.wrap(read)
+
+    # The transactions are pulled up to the last period end of either portfolio and all the views
+    for script, codes in portfolios:
+        script.horizon = max(script.views[name][0][-1] for name in args.views)
+    shared = SharedTransactions([codes for script, codes in portfolios], max(script.horizon for script, codes in portfolios))
+    read = shared.wrap(read)
+
+    def run(position):
+        script = portfolios[position][0]
+        reports[position] = current.report = RunReport(script.__name__)
+        for name in args.views:
+            script.select_view(name)
+            print("Running " + script.__name__ + ", " + name + " view")
+            script.update(args, read, reports[position])
+        if args.status_index is not None and not args.dry_run:
+            script.write_status_index(args, read, reports[position])
+
+    try:
+        with ThreadPoolExecutor(max_workers=1 if args.sequential else len(portfolios)) as pool:
+            futures = [pool.submit(run, position) for position in range(len(portfolios))]
+        # every portfolio runs to the end, the first error is raised afterwards
+        for future in futures:
+            future.result()
+    finally:
+        if base is not None and base.prepared:
+            base.drop(execute)
+        for run_report in [report] + [r for r in reports if r is not None]:
+            print(run_report.summary())
+            if args.report is not None:
+                run_report.write(args.report + '_' + run_report.name)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Vectorised due dates and aging buckets of both portfolios.
+#
+# The due date rules and the delinquency buckets are spelled out as SQL CASE ladders in the period queries
+# of CBWeekly.py (date_calc / accessed) and CoverWeeklyUpdate.py (final / final2), for one snapshot per
+# query. The same rules are implemented here on whole arrays at once, so that the replay engine
+# (replay_engine.py) and the status index (status_index.py) work them out for every snapshot in one go.
+#
+# Days are datetime64[D] arrays, i.e. int64 day numbers since 1970-01-01 (int64 arrays are taken as such),
+# with NaT for a missing day, which carries through the arithmetic. The thresholds are parameters, with the
+# values the SQL uses as defaults. --verify-aging YYYY-MM-DD in either script checks the results against
+# the SQL for one snapshot.
+
+import numpy as np
+
+ONE_DAY = np.timedelta64(1, 'D')
+
+# Days late at which the 1-30, 31-60, 61-90 and 91+ buckets start
+AGING_EDGES = (1, 31, 61, 91)
+
+
+def as_days(values):
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        return values.astype('int64').view('datetime64[D]')
+    return values.astype('datetime64[D]')
+
+
+def cb_due_day(last_tr, last_withdraw, repaid_last, repaid, prev_os, min_payment=67.50, min_payment_rate=0.3, term=30):
+    # Credit Building due date (date_calc in CBWeekly.py). last_tr: day of the last transaction, last_withdraw:
+    # day of the latest withdrawal, repaid_last: the last transaction is a repayment on the latest withdrawal,
+    # repaid: sum of the repayments on the latest withdrawal, prev_os: OS before them.
+    # Repayments only count if they are the last transaction: a user who owed more than min_payment and paid
+    # at least the minimum payment (but not all of it) is due term days after the payment, every other case
+    # runs from the last disbursement. If the last transaction is a withdrawal, it runs from it (it is ASSUMED
+    # that the user was allowed to withdraw, i.e. the system checked that the user was current)
+    last_tr = as_days(last_tr)
+    last_withdraw = as_days(last_withdraw)
+    repaid = np.asarray(repaid, dtype='float64')
+    prev_os = np.asarray(prev_os, dtype='float64')
+    minimum_paid = ((prev_os > min_payment) & (repaid < prev_os)
+                    & (repaid >= np.maximum(min_payment_rate * prev_os, min_payment)))
+    start = np.where(np.asarray(repaid_last, dtype=bool) & ~minimum_paid, last_withdraw, last_tr)
+    return start + np.timedelta64(term, 'D')
+
+
+def cover_due_day(last_loan, last_fee, num_fees, end, do_not_collect_start='2022-05-01', term=30):
+    # CoverMe due date (final in CoverWeeklyUpdate.py) as of the days end, with the number of fee payments
+    # expected since the last disbursal (one every term days). Disbursals up to do_not_collect_start are due
+    # term days after the disbursal. Later ones stay current as long as the fees are paid: term days after the
+    # last fee (or the disbursal) if every expected fee was paid, otherwise term days after the first missed one
+    last_loan = as_days(last_loan)
+    last_fee = as_days(last_fee)
+    num_fees = np.asarray(num_fees, dtype='int64')
+    end = as_days(end)
+    with np.errstate(invalid='ignore'):
+        # no expected fees without a disbursal
+        expected = ((end - last_loan) / ONE_DAY).astype('int64') // term
+    fee_based = np.where(np.isnat(last_fee), last_loan, last_fee) + np.timedelta64(term, 'D')
+    due = np.where(last_loan <= np.datetime64(do_not_collect_start, 'D'), last_loan + np.timedelta64(term, 'D'),
+                   np.where(num_fees >= expected, fee_based, last_loan + ((1 + num_fees) * term).astype('timedelta64[D]')))
+    return expected, due
+
+
+def days_late(end, due):
+    # days between the due date and end, NaN without a due date
+    return (as_days(end) - as_days(due)) / ONE_DAY
+
+
+def aging_bucket(late, edges=AGING_EDGES):
+    # 0 for not late (less than edges[0] days late, or no due date), i for edges[i-1] <= late < edges[i]
+    late = np.asarray(late, dtype='float64')
+    return np.searchsorted(np.asarray(edges, dtype='float64'), np.where(np.isnan(late), -np.inf, late), side='right')
+
+
+def bucket_labels(first, number=1, edges=AGING_EDGES):
+    # Status labels of the buckets, e.g. bucket_labels('Current') -> 1. Current, 2. 1 to 30, ..., 5. 91+
+    labels = [str(number) + '. ' + first]
+    for i, edge in enumerate(edges):
+        span = str(edge) + ' to ' + str(edges[i + 1] - 1) if i + 1 < len(edges) else str(edge) + '+'
+        labels.append(str(number + i + 1) + '. ' + span)
+    return np.array(labels, dtype=object)
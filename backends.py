@@ -0,0 +1,222 @@
+# Data-source backends for the weekly scripts.
+#
+# Every backend offers the same operations:
+#   read(sql)                                  run a query and return the result as a DataFrame
+#   execute(statement)                         run a statement that returns no rows (DDL / DML)
+#   write(frame, table, if_exists)             write a DataFrame to a table ('replace' or 'append')
+#   replace_partitions(frame, table, column, since)
+#                                              replace the rows with column >= since by frame (append / merge)
+#   has_table(table)
+#   is_partitioned(table, column)              whether the table is partitioned by the (date) column
+#   load_partition(path, table, column, partition, schema)
+#                                              replace one partition by the rows of a Parquet file (uploader.py)
+#   estimate(sql)                              bytes the query would scan without running it, None if unknown (preflight.py)
+# and hands the statistics of every query / statement to on_query(stats) if set (see run_report.py):
+#   job_id, bytes_processed, slot_ms (BigQuery only), seconds, rows
+#
+# BigQueryBackend runs queries and statements through the BigQuery client and uploads with pandas_gbq.
+# DuckDBBackend runs the same standard-SQL queries against a local DuckDB file, so the pipeline can be run,
+# profiled and benchmarked without GCP access. The queries are translated from BigQuery SQL with sqlglot.
+# Fixture tables are loaded from files named <dataset>.<table>.parquet (or .csv), e.g.
+#   kohoapi.transaction_succeeded_events   UserAccount, PostedAt (UTC timestamp), TransactionID, Amount ('$12.50'), PaymentCode
+#   accounts.kledger_accounts              account_group_identifier, user_reference
+#   feature.loans                          account_identifier, loan_type, amount, status, created_at, updated_at
+#   transaction.kledger_transaction_lines  user_reference, TIMESTAMP, description
+#   credit.ep_migration_list               string_field_0
+
+import glob
+import os
+import re
+import threading
+import time
+
+import pandas as pd
+
+
+# Parquet types of uploader.parquet_schema and the BigQuery column types they are loaded as
+bigquery_types = {'string': 'STRING', 'timestamp[us]': 'DATETIME', 'bool': 'BOOL', 'int64': 'INT64', 'double': 'FLOAT64'}
+
+
+class Backend:
+
+    on_query = None
+
+    def record(self, began, rows=None, job=None):
+        if self.on_query is None:
+            return
+        stats = {'job_id': None, 'bytes_processed': None, 'slot_ms': None,
+                 'seconds': round(time.perf_counter() - began, 3), 'rows': rows}
+        if job is not None:
+            # load jobs have no bytes processed
+            stats.update(job_id=job.job_id, bytes_processed=getattr(job, 'total_bytes_processed', None),
+                         slot_ms=getattr(job, 'slot_millis', None))
+        self.on_query(stats)
+
+
+class BigQueryBackend(Backend):
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self._client = None
+        self.lock = threading.Lock()
+
+    def client(self):
+        with self.lock:
+            if self._client is None:
+                from google.cloud import bigquery
+                self._client = bigquery.Client(project=self.project_id)
+            return self._client
+
+    def read(self, sql):
+        # Through the client rather than pandas_gbq.read_gbq so that the job statistics are available
+        began = time.perf_counter()
+        job = self.client().query(sql)
+        frame = job.to_dataframe(progress_bar_type=None)
+        self.record(began, len(frame), job)
+        return frame
+
+    def execute(self, statement):
+        began = time.perf_counter()
+        job = self.client().query(statement)
+        job.result()
+        self.record(began, job=job)
+
+    def write(self, frame, table, if_exists='replace'):
+        import pandas_gbq as pgbq
+        began = time.perf_counter()
+        pgbq.to_gbq(frame, table, self.project_id, if_exists=if_exists, progress_bar=False)
+        self.record(began, len(frame))
+
+    def replace_partitions(self, frame, table, column, since):
+        self.execute("delete from {0} where date({1}) >= '{2}'".format(table, column, since))
+        self.write(frame, table, if_exists='append')
+
+    def has_table(self, table):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.client().get_table(table)
+        except NotFound:
+            return False
+        return True
+
+    def estimate(self, sql):
+        # dry run, free of charge
+        from google.cloud import bigquery
+        job = self.client().query(sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+        return job.total_bytes_processed
+
+    def is_partitioned(self, table, column):
+        partitioning = self.client().get_table(table).time_partitioning
+        return partitioning is not None and partitioning.field == column
+
+    def load_partition(self, path, table, column, partition, schema):
+        # Loads into the partition decorator table$YYYYMMDD, replacing that partition only.
+        # Creates the table partitioned by column if it does not exist yet
+        from google.cloud import bigquery
+        began = time.perf_counter()
+        config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET,
+                                        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+                                        time_partitioning=bigquery.TimePartitioning(field=column),
+                                        schema=[bigquery.SchemaField(field.name, bigquery_types[str(field.type)]) for field in schema])
+        with open(path, 'rb') as f:
+            job = self.client().load_table_from_file(f, table + '$' + partition.strftime('%Y%m%d'), job_config=config)
+        job.result()
+        self.record(began, job.output_rows, job)
+
+
+class DuckDBBackend(Backend):
+
+    def __init__(self, path=':memory:', fixtures=None):
+        import duckdb
+        self.con = duckdb.connect(path)
+        if fixtures is not None:
+            self.load_fixtures(fixtures)
+
+    def cursor(self):
+        # one cursor per call, a DuckDB connection must not be shared between threads
+        cursor = self.con.cursor()
+        # BigQuery timestamps are in UTC
+        cursor.execute("SET TimeZone = 'UTC'")
+        return cursor
+
+    def estimate(self, sql):
+        # no dry run locally, the estimates recorded from BigQuery runs are used instead (preflight.py)
+        return None
+
+    def translate(self, sql):
+        import sqlglot
+        return sqlglot.transpile(sql, read='bigquery', write='duckdb')[0]
+
+    def read(self, sql):
+        began = time.perf_counter()
+        frame = self.cursor().execute(self.translate(sql)).df()
+        self.record(began, len(frame))
+        return frame
+
+    def execute(self, statement):
+        # BigQuery datasets exist beforehand, DuckDB schemas are created on first use
+        created = re.match(r'\s*create\s+(?:or\s+replace\s+)?table\s+(?:if\s+not\s+exists\s+)?([\w.]+)', statement, re.IGNORECASE)
+        if created:
+            self.create_schema(created.group(1))
+        began = time.perf_counter()
+        self.cursor().execute(self.translate(statement))
+        self.record(began)
+
+    def create_schema(self, table):
+        if '.' in table:
+            self.cursor().execute("create schema if not exists " + table.split('.')[0])
+
+    def write(self, frame, table, if_exists='replace'):
+        began = time.perf_counter()
+        self.create_schema(table)
+        cursor = self.cursor()
+        cursor.register('frame', frame)
+        # categoricals would become ENUM columns, they are stored as plain text like in BigQuery
+        select = ", ".join('cast("{0}" as varchar) as "{0}"'.format(column) if isinstance(frame[column].dtype, pd.CategoricalDtype)
+                           else '"{0}"'.format(column) for column in frame.columns)
+        if if_exists == 'append' and self.has_table(table):
+            cursor.execute("insert into {0} by name select {1} from frame".format(table, select))
+        else:
+            cursor.execute("create or replace table {0} as select {1} from frame".format(table, select))
+        cursor.unregister('frame')
+        self.record(began, len(frame))
+
+    def replace_partitions(self, frame, table, column, since):
+        if self.has_table(table):
+            self.cursor().execute("delete from {0} where cast({1} as date) >= date '{2}'".format(table, column, since))
+        self.write(frame, table, if_exists='append')
+
+    def has_table(self, table):
+        schema, name = table.split('.') if '.' in table else ('main', table)
+        found = self.cursor().execute("select count(*) from information_schema.tables where table_schema = ? and table_name = ?",
+                                      [schema, name]).fetchone()[0]
+        return found > 0
+
+    def is_partitioned(self, table, column):
+        # DuckDB tables are not partitioned, load_partition replaces the rows of the partition instead
+        return True
+
+    def load_partition(self, path, table, column, partition, schema):
+        began = time.perf_counter()
+        self.create_schema(table)
+        cursor = self.cursor()
+        if self.has_table(table):
+            cursor.execute("delete from {0} where cast({1} as date) = date '{2}'".format(table, column, partition.strftime('%Y-%m-%d')))
+            cursor.execute("insert into {0} by name select * from read_parquet(?)".format(table), [path])
+        else:
+            cursor.execute("create table {0} as select * from read_parquet(?)".format(table), [path])
+        self.record(began)
+
+    def load_fixtures(self, directory):
+        # <dataset>.<table>.parquet / .csv files become the table dataset.table
+        for path in sorted(glob.glob(os.path.join(directory, '*.*.parquet')) + glob.glob(os.path.join(directory, '*.*.csv'))):
+            table = os.path.basename(path).rsplit('.', 1)[0]
+            self.create_schema(table)
+            reader = 'read_parquet' if path.endswith('.parquet') else 'read_csv_auto'
+            self.cursor().execute("create or replace table {0} as select * from {1}(?)".format(table, reader), [path])
+
+
+def from_options(options, project_id):
+    if options.backend == 'duckdb':
+        return DuckDBBackend(options.duckdb_path, options.fixtures)
+    return BigQueryBackend(project_id)
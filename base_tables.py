@@ -0,0 +1,49 @@
+# Shared pre-materialised base tables for the weekly queries.
+#
+# Both portfolio queries map UserAccount to user_reference through accounts.kledger_accounts and filter
+# kohoapi.transaction_succeeded_events on the payment codes of the portfolio, for every single period
+# (CBWeekly.py even builds the mapping three times per query). The preparation stage materialises the
+# account mapping and the transactions of the portfolio into scratch tables once per run, and the period
+# queries and the ever_query are pointed at them, which cuts the bytes scanned per run.
+#
+# The scratch tables hold the same columns as the source tables (the mapping only the two columns the
+# queries use), so pointing a query at them is a matter of swapping the table names.
+
+import re
+
+source_transactions = 'kohoapi.transaction_succeeded_events'
+source_accounts = 'accounts.kledger_accounts'
+
+
+class BaseTables:
+
+    def __init__(self, dataset, name):
+        self.mapping = dataset + '.' + name + '_account_mapping'
+        self.transactions = dataset + '.' + name + '_transactions'
+        self.prepared = False
+
+    def statements(self, payment_codes):
+        codes = ", ".join("'" + code + "'" for code in payment_codes)
+        return ["""create or replace table {0} as
+    select distinct account_group_identifier, user_reference from {1}""".format(self.mapping, source_accounts),
+                """create or replace table {0} as
+    select * from {1} where PaymentCode in ({2})""".format(self.transactions, source_transactions, codes)]
+
+    def prepare(self, execute, payment_codes):
+        # execute(statement) runs a statement that returns no rows
+        for statement in self.statements(payment_codes):
+            execute(statement)
+        self.prepared = True
+
+    def drop(self, execute):
+        execute("drop table if exists " + self.mapping)
+        execute("drop table if exists " + self.transactions)
+        self.prepared = False
+
+    def rewrite(self, sql):
+        sql = re.sub(r'\b' + re.escape(source_transactions) + r'\b', self.transactions, sql)
+        return re.sub(r'\b' + re.escape(source_accounts) + r'\b', self.mapping, sql)
+
+    def wrap(self, read):
+        # read(query, period_end) reading from the base tables instead of the source tables
+        return lambda query, period_end=None: read(self.rewrite(query), period_end)
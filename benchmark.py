@@ -0,0 +1,156 @@
+# Benchmark of the weekly pipelines on synthetic portfolios (synthetic.py), run with the DuckDB backend.
+#
+# Times every stage of CBWeekly.py / CoverWeeklyUpdate.py at a number of portfolio sizes:
+#   fetch           the period queries (sql engine) or the transaction pull (replay engine)
+#   stack           stacking the per-period results (sql engine) or replaying the transactions (replay engine)
+#   dtype           dbdate to datetime conversion
+#   transitions     previous snapshot status
+#   classification  status flags (rules.py)
+#   upload          writing the output table
+# Every run is appended to a JSON history file and compared with the previous run with the same settings,
+# so that regressions show up between versions:
+#   python benchmark.py --users 10000 100000 1000000 --engine replay
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import subprocess
+import time
+
+import pandas as pd
+
+import backends
+import fetch_pool
+import synthetic
+from frame_collector import convert_dates
+
+stages = ['fetch', 'stack', 'dtype', 'transitions', 'classification', 'upload']
+
+
+def version():
+    # the commit being benchmarked, if run from a git checkout
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fixtures(data_dir, users, weeks, seed):
+    # Generated portfolios are kept so that repeated benchmarks do not pay for the generation
+    directory = os.path.join(data_dir, '{0}u_{1}w_{2}'.format(users, weeks, seed))
+    if not os.path.exists(os.path.join(directory, 'kohoapi.transaction_succeeded_events.parquet')):
+        print("Generating " + str(users) + " users, " + str(weeks) + " weeks")
+        synthetic.write_fixtures(synthetic.generate(users, weeks, seed=seed), directory)
+    return directory
+
+
+def timed(timings, stage, fn, *args):
+    began = time.perf_counter()
+    result = fn(*args)
+    timings[stage] = timings.get(stage, 0) + time.perf_counter() - began
+    return result
+
+
+def run_pipeline(script, backend, engine, ends, workers):
+    # Runs one script stage by stage against the backend, returns (timings, rows in, rows out)
+    mod = importlib.import_module(script)
+    mod.backend = backend
+    read = mod.read_query
+    timings = {}
+
+    if engine == 'replay':
+        # reads happen one after the other inside replay_periods, the rest of its time is the replay
+        def timed_read(query, period_end=None):
+            return timed(timings, 'fetch', read, query, period_end)
+        began = time.perf_counter()
+        stacked = mod.replay_periods(ends, None, timed_read)
+        timings['stack'] = time.perf_counter() - began - timings.get('fetch', 0)
+    else:
+        start = mod.periods[0].strftime('%Y-%m-%d')
+        frames = timed(timings, 'fetch', fetch_pool.fetch_all, ends,
+                       lambda end: mod.loans_by_period(start, end.strftime('%Y-%m-%d'), read), workers)
+        stacked = timed(timings, 'stack', lambda: pd.concat(frames, ignore_index=True))
+
+    stacked = timed(timings, 'dtype', convert_dates, stacked)
+
+    if script == 'CBWeekly':
+        ever = timed(timings, 'fetch', read, mod.ever_query)
+        ordered = timed(timings, 'transitions',
+                        lambda: mod.order_snapshots(mod.add_ever_accessed(stacked, lambda query, period_end=None: ever)))
+    else:
+        ordered = timed(timings, 'transitions', mod.add_prev_status, stacked)
+    final = timed(timings, 'classification', mod.classify, ordered)
+
+    timed(timings, 'upload', backend.write, final, 'benchmark.' + script)
+    return timings, len(stacked), len(final)
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def previous_run(history, record):
+    same = ['script', 'engine', 'users', 'weeks']
+    for earlier in reversed(history):
+        if all(earlier.get(key) == record[key] for key in same):
+            return earlier
+    return None
+
+
+def report(record, previous):
+    print(record['script'] + " " + record['engine'] + ", " + str(record['users']) + " users, "
+          + str(record['weeks']) + " weeks, " + str(record['rows_out']) + " rows")
+    for stage in stages + ['total']:
+        line = "  {0:<15}{1:>10.2f}s".format(stage, record['timings'][stage])
+        if previous is not None and previous['timings'].get(stage):
+            line += "  {0:>6.2f}x of {1}".format(record['timings'][stage] / previous['timings'][stage],
+                                                 previous.get('version') or previous['date'])
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the weekly pipelines on synthetic portfolios')
+    parser.add_argument('--script', nargs='+', choices=['CBWeekly', 'CoverWeeklyUpdate'],
+                        default=['CBWeekly', 'CoverWeeklyUpdate'])
+    parser.add_argument('--users', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--weeks', type=int, default=26)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', choices=['sql', 'replay'], default='sql')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--data-dir', default='.benchmark',
+                        help='directory for the generated portfolios')
+    parser.add_argument('--history', default='benchmark_history.json',
+                        help='JSON file the results are appended to')
+    args = parser.parse_args(argv)
+
+    history = load_history(args.history)
+    start = pd.Timestamp('2022-04-01')
+    end = start + datetime.timedelta(weeks=args.weeks)
+
+    for users in args.users:
+        directory = fixtures(args.data_dir, users, args.weeks, args.seed)
+        backend = backends.DuckDBBackend(':memory:', directory)
+        for script in args.script:
+            # only the weeks the synthetic portfolio covers
+            ends = [p for p in importlib.import_module(script).periods[1:] if start < p <= end]
+            timings, rows_in, rows_out = run_pipeline(script, backend, args.engine, ends, args.workers)
+            timings['total'] = sum(timings.values())
+
+            record = {'version': version(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                      'script': script, 'engine': args.engine, 'users': users, 'weeks': args.weeks,
+                      'rows_in': rows_in, 'rows_out': rows_out,
+                      'timings': {stage: round(seconds, 3) for stage, seconds in timings.items()}}
+            report(record, previous_run(history, record))
+            history.append(record)
+
+            with open(args.history, 'w') as f:
+                json.dump(history, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Detection of late-arriving and corrected transactions.
+#
+# The incremental mode only recomputes the weeks from the last stored snapshot on, so a transaction that
+# arrives late (or is corrected) in an earlier week used to need a full --rebuild. The transactions of the
+# portfolio are fingerprinted per user and week (count, sum of amounts and max TransactionID) on every run
+# and the fingerprints are kept next to the upload manifest (upload_dir/<table>/fingerprints.parquet).
+# Comparing them with the stored fingerprints of the previous run gives the users whose transactions changed
+# and the earliest week that changed, and only the snapshots of those users from that week on are
+# recomputed (with the replay engine) and patched into the output table.
+#
+# Only changes to the transactions are detected, e.g. not changes to feature.loans or the CoverMe flag lists.
+
+import os
+
+import pandas as pd
+
+from frame_collector import convert_dates
+
+keys = ['user_reference', 'week']
+measures = ['transactions', 'amount', 'max_transaction_id']
+
+
+def fingerprint_query(payment_codes, end):
+    return """select
+    b.user_reference,
+    last_day(date(a.PostedAt,'America/Denver'), ISOWEEK) as week,
+    count(*) as transactions,
+    round(sum(cast(trim(a.Amount,"$") as FLOAT64)), 2) as amount,
+    max(a.TransactionID) as max_transaction_id
+    from kohoapi.transaction_succeeded_events as a
+        inner join
+        (select distinct account_group_identifier, user_reference from accounts.kledger_accounts group by 1,2) as b
+            on a.UserAccount = b.account_group_identifier
+    where a.PaymentCode in ({0}) and date(a.PostedAt,'America/Denver') <= '{1}'
+    group by 1,2""".format(", ".join("'" + code + "'" for code in payment_codes), end)
+
+
+def fingerprint_path(upload_dir, table):
+    return os.path.join(upload_dir, table, 'fingerprints.parquet')
+
+
+def read_fingerprints(read, payment_codes, end):
+    fingerprints = convert_dates(read(fingerprint_query(payment_codes, end)))
+    fingerprints['user_reference'] = fingerprints['user_reference'].astype(object)
+    fingerprints['week'] = fingerprints['week'].astype('datetime64[ns]')
+    return fingerprints
+
+
+def load_fingerprints(path):
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def save_fingerprints(path, fingerprints):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fingerprints.to_parquet(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def changed_weeks(previous, current, before=None):
+    # The first day (Monday) of the earliest changed week of every user whose fingerprint changed (a Series
+    # indexed by user_reference), only counting the weeks starting before `before` (YYYY-MM-DD) if given.
+    # Weeks are ISO weeks, the snapshots to recompute are the period ends from that Monday on: on a monthly
+    # (or custom) grid the week of a changed day can end in the next period
+    merged = previous.merge(current, on=keys, how='outer', suffixes=('_previous', ''), indicator=True)
+    differs = (merged['_merge'] != 'both').to_numpy()
+    for measure in measures:
+        differs = differs | merged[measure + '_previous'].ne(merged[measure]).to_numpy(dtype=bool)
+    changed = merged.loc[differs, keys]
+    changed = changed.assign(week=changed['week'] - pd.Timedelta(days=6))
+    if before is not None:
+        changed = changed[changed['week'] < pd.Timestamp(before)]
+    return changed.groupby('user_reference')['week'].min()
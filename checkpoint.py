@@ -0,0 +1,77 @@
+# Checkpoint / resume for the period loop.
+#
+# After each completed period the fetched chunk is written to Parquet and recorded in a manifest, so a run
+# that fails at week 77 of 78 only has to fetch the missing week when it is started again. The manifest
+# belongs to one run, identified by the script and the list of period ends; a run over different periods
+# (e.g. the next week) starts from scratch. The checkpoint is cleared once the results are uploaded.
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from frame_collector import convert_dates
+
+
+class Checkpoint:
+
+    def __init__(self, checkpoint_dir, run_key):
+        self.checkpoint_dir = checkpoint_dir
+        self.run_key = hashlib.sha256(run_key.encode('utf-8')).hexdigest()
+        self.manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+        self.lock = threading.Lock()
+
+        self.done = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest['run_key'] == self.run_key:
+                self.done = {int(position): entry for position, entry in manifest['done'].items()}
+            else:
+                # left over from a different run
+                self.clear()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def completed(self):
+        # position -> Parquet file of every period that is already done
+        return {position: os.path.join(self.checkpoint_dir, entry['file'])
+                for position, entry in self.done.items()
+                if os.path.exists(os.path.join(self.checkpoint_dir, entry['file']))}
+
+    def pending(self, count):
+        completed = self.completed()
+        return [position for position in range(count) if position not in completed]
+
+    def record(self, frame, position, period):
+        frame = convert_dates(frame)
+        name = 'period_' + str(position) + '.parquet'
+        frame.to_parquet(os.path.join(self.checkpoint_dir, name), index=False)
+
+        with self.lock:
+            self.done[position] = {'period': str(period)[:10], 'file': name, 'rows': len(frame)}
+            self._save()
+        return frame
+
+    def clear(self):
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        self.done = {}
+
+    def _save(self):
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'run_key': self.run_key,
+                       'done': {str(position): entry for position, entry in self.done.items()}}, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+
+def from_options(options, name, ends):
+    # The checkpoint of this run, None when resuming is switched off
+    if options.checkpoint_dir is None:
+        return None
+    run_key = name + '|' + ','.join(str(end)[:10] for end in ends)
+    progress = Checkpoint(os.path.join(options.checkpoint_dir, name), run_key)
+    if options.fresh:
+        progress.clear()
+        os.makedirs(progress.checkpoint_dir, exist_ok=True)
+    return progress
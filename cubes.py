@@ -0,0 +1,55 @@
+# Pre-aggregated companion tables of the portfolio views for the dashboards.
+#
+# The MetaBase dashboards aggregate the full output tables (millions of rows) by snapshot, prev_status ->
+# snapshot_status and cohort on every page load. With --cubes the scripts also write these aggregates as
+# small companion tables next to the output table (<out_table><suffix>, e.g. the roll rate matrix
+# credit.CB_finance_view_weekly_roll_rates), one row per snapshot and combination of the dimensions with:
+#
+#   num_rows      rows of the view (accounts in CBWeekly.py, users in CoverWeeklyUpdate.py)
+#   num_users     distinct users
+#   total_OS      sum of OS, for OS-weighted roll rates and vintage curves
+#   <count>       rows with a flag value, e.g. new_defaults (new_default = '1. Yes')
+#
+# The tables and counts are configured in the scripts (cube_tables, cube_counts). Every row of a view only
+# counts towards the cube rows of its own snapshot, so the cubes are built from the snapshots a run produces
+# and uploaded with the same partitioned upload (uploader.py), i.e. an incremental run only aggregates and
+# uploads the new weeks. Snapshots patched for late-arriving transactions (change_detection.py) are
+# aggregated again from the stored rows.
+
+import pandas as pd
+
+import uploader
+from frame_collector import convert_dates
+
+
+def build(final, dimensions, counts):
+    # final: rows of the view, dimensions: columns next to the snapshot, counts: {name: (column, value)}.
+    # Missing dimension values form their own group
+    flags = {name: (final[column] == value).astype('int64') for name, (column, value) in counts.items()}
+    frame = final[['snapshot', 'user_reference', 'OS'] + dimensions].assign(num_rows=1, **flags)
+    cube = frame.groupby(['snapshot'] + dimensions, dropna=False, sort=True, observed=True).agg(
+        num_rows=('num_rows', 'sum'), num_users=('user_reference', 'nunique'), total_OS=('OS', 'sum'),
+        **{name: (name, 'sum') for name in counts})
+    cube = cube.reset_index()
+    cube['total_OS'] = cube['total_OS'].round(2)
+    return cube
+
+
+def update(final, table, cube_tables, counts, backend, since=None, upload_dir='.upload'):
+    # The cubes of the snapshots in final (all of them if since is None, otherwise from since on, like uploader.upload)
+    rows = 0
+    for suffix, dimensions in cube_tables.items():
+        cube = build(final, dimensions, counts)
+        uploader.upload(cube, table + suffix, backend, since, upload_dir=upload_dir)
+        rows += len(cube)
+    return rows
+
+
+def refresh(table, cube_tables, counts, backend, first, last, upload_dir='.upload'):
+    # The cubes of the stored snapshots first..last (YYYY-MM-DD, inclusive), after rows of them were patched
+    columns = ['snapshot', 'user_reference', 'OS'] + sorted(set(
+        [column for dimensions in cube_tables.values() for column in dimensions] + [column for column, value in counts.values()]))
+    stored = convert_dates(backend.read("select {0} from {1} where date(snapshot) between '{2}' and '{3}'".format(
+        ", ".join(dict.fromkeys(columns)), table, first, last)))
+    for suffix, dimensions in cube_tables.items():
+        uploader.replace_snapshots(build(stored, dimensions, counts), table + suffix, backend, first, last, upload_dir=upload_dir)
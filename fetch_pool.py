@@ -0,0 +1,65 @@
+# Concurrent fetch of the per-period snapshots.
+#
+# Each period is an independent BigQuery job, so instead of waiting for one download to finish before
+# starting the next one, the periods are fetched through a bounded thread pool. Each period is retried
+# with exponential backoff, and the results are handed back in period order.
+#
+# `fetch` is any callable taking a period and returning a DataFrame, e.g.
+#     lambda end: loans_by_period(start, end)
+# so a local fake of read_gbq can be plugged in to exercise the pool without BigQuery.
+
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+def fetch_with_retry(fetch, period, retries=3, backoff=2.0, sleep=time.sleep):
+    attempt = 0
+    while True:
+        try:
+            return fetch(period)
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            wait = backoff * 2 ** attempt
+            attempt += 1
+            print("Fetching " + str(period) + " failed (" + str(e) + "), retry " + str(attempt) + " in " + str(wait) + "s")
+            sleep(wait)
+
+
+def fetch_all(periods, fetch, workers=4, retries=3, backoff=2.0, sleep=time.sleep, on_result=None):
+    # Returns the fetched frames in the same order as `periods`.
+    # With on_result, each frame is instead handed over as on_result(frame, position) as soon as it
+    # arrives and nothing is kept here (e.g. FrameCollector.add)
+    periods = list(periods)
+    results = [None] * len(periods)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(fetch_with_retry, fetch, period, retries, backoff, sleep): i
+                   for i, period in enumerate(periods)}
+        done = 0
+        error = None
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                frame = future.result()
+            except Exception as e:
+                # Out of retries: stop starting new periods, but keep the ones that are still running
+                # so that they can be recorded (e.g. by the checkpoint) before the error is raised
+                if error is None:
+                    error = e
+                    for other in futures:
+                        other.cancel()
+                continue
+            if on_result is not None:
+                on_result(frame, futures[future])
+            else:
+                results[futures[future]] = frame
+            done += 1
+            print(str(done) + " out of " + str(len(periods)))
+
+        if error is not None:
+            raise error
+
+    if on_result is None:
+        return results
@@ -0,0 +1,131 @@
+# Collects the per-period chunks of the stacked snapshot frame.
+#
+# Growing the stacked frame with pd.concat([curr_loans, chunk]) copies everything gathered so far on every
+# period, which is quadratic in the number of weeks. The collector keeps the chunks and concatenates them
+# once at the end. If a memory budget is given, chunks are spilled to Parquet files once the chunks held in
+# memory exceed it and read back for the final concat.
+#
+# The budget only bounds the gathering phase, i.e. the time the periods are being fetched. result() reads
+# every spilled chunk back and concatenates them, so its peak is the full stacked frame plus all the chunks
+# (about twice the stacked frame), the same as without a budget. The stages after it (previous status,
+# classification, upload) need the whole stacked frame, e.g. to order the snapshots of every user.
+#
+# Chunks are normalised as they come in (dbdate columns become datetime64, text columns categoricals) so
+# every chunk has the same dtypes and the conversion runs once per chunk rather than over the full stacked
+# frame. The user references, account identifiers and status labels repeat on every weekly snapshot, as
+# categoricals each distinct string is held once per chunk and the rows only hold integer codes.
+
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+
+
+def convert_dates(frame):
+    # dbdate (DATE columns from BigQuery) to datetime64
+    for column in frame.columns:
+        if frame[column].dtype == "dbdate":
+            frame[column] = pd.to_datetime(frame[column])
+    return frame
+
+
+def compact(frame):
+    # convert_dates, and text columns to categoricals
+    frame = convert_dates(frame)
+    for column in frame.columns:
+        values = frame[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_string_dtype(values.dtype) and pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            frame[column] = values.astype('category')
+    return frame
+
+
+def align_categories(frames):
+    # Categoricals only stay categorical through pd.concat if every chunk has the same categories.
+    # The categories are sorted so that sorting on a categorical column sorts on the text
+    columns = {column for frame in frames for column in frame.columns if isinstance(frame[column].dtype, pd.CategoricalDtype)}
+    for column in columns:
+        categories = set()
+        for frame in frames:
+            if column not in frame.columns:
+                continue
+            values = frame[column]
+            categories.update(values.cat.categories if isinstance(values.dtype, pd.CategoricalDtype) else values.dropna().unique())
+        dtype = pd.CategoricalDtype(sorted(categories))
+        for frame in frames:
+            if column in frame.columns:
+                frame[column] = frame[column].astype(dtype)
+    return frames
+
+
+class FrameCollector:
+
+    def __init__(self, memory_budget_mb=None, spill_dir=None):
+        # None keeps every chunk in memory
+        self.memory_budget = None if memory_budget_mb is None else int(memory_budget_mb * 2**20)
+        self.spill_dir = spill_dir
+        self.own_spill_dir = False
+        self.chunks = {}            # position -> DataFrame or path of a Parquet file
+        self.spilled = set()        # Parquet files written by the collector itself
+        self.sizes = {}
+        self.in_memory = 0
+
+    def add(self, chunk, position=None):
+        # position orders the chunks in the final frame (defaults to the order in which they were added)
+        if position is None:
+            position = len(self.chunks)
+        chunk = compact(chunk)
+        self.chunks[position] = chunk
+        self.sizes[position] = int(chunk.memory_usage(deep=True).sum())
+        self.in_memory += self.sizes[position]
+
+        if self.memory_budget is not None and self.in_memory > self.memory_budget:
+            self.spill()
+
+    def add_file(self, path, position):
+        # A chunk that is already on disk (e.g. a checkpointed period), read at the final concat
+        self.chunks[position] = path
+        self.sizes[position] = 0
+
+    def spill(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='frame_collector_')
+            self.own_spill_dir = True
+        os.makedirs(self.spill_dir, exist_ok=True)
+
+        # largest chunks first until we are back under budget
+        for position in sorted(self.sizes, key=self.sizes.get, reverse=True):
+            if self.in_memory <= self.memory_budget:
+                break
+            chunk = self.chunks[position]
+            if isinstance(chunk, str):
+                continue
+            path = os.path.join(self.spill_dir, 'chunk_' + str(position) + '.parquet')
+            chunk.to_parquet(path, index=False)
+            self.chunks[position] = path
+            self.spilled.add(path)
+            self.in_memory -= self.sizes[position]
+
+    def result(self):
+        frames = []
+        for position in sorted(self.chunks):
+            chunk = self.chunks[position]
+            if isinstance(chunk, str):
+                frames.append(pd.read_parquet(chunk))
+                if chunk in self.spilled:
+                    os.remove(chunk)
+            else:
+                frames.append(chunk)
+        if not frames:
+            return pd.DataFrame()
+        stacked = pd.concat(align_categories(frames), ignore_index=True)
+
+        self.chunks = {}
+        self.sizes = {}
+        self.spilled = set()
+        self.in_memory = 0
+        if self.own_spill_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        return stacked
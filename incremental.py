@@ -0,0 +1,57 @@
+# Helpers for the incremental mode of the weekly scripts.
+#
+# Rather than regenerating every snapshot since the start of the portfolio, we look up the last
+# snapshot already stored in the output table and only compute the weeks from there on.
+# The last stored week is always recomputed as it may have been written before the week closed.
+# The stored snapshot just before the recomputed weeks is read back so that week over week
+# columns (prev_status etc.) can be calculated for the first recomputed week.
+
+import pandas as pd
+
+
+def last_stored_snapshot(out_table, backend, before=None):
+    # Returns the most recent snapshot in the output table (strictly before `before` if given),
+    # or None if the table does not exist yet / is empty
+    if not backend.has_table(out_table):
+        return None
+
+    query = "select max(snapshot) as last_snapshot from {0}".format(out_table)
+    if before is not None:
+        query += " where date(snapshot) < '{0}'".format(before)
+
+    result = backend.read(query)
+
+    if result.empty or pd.isnull(result['last_snapshot'][0]):
+        return None
+    return pd.Timestamp(result['last_snapshot'][0])
+
+
+def resume_point(out_table, backend, since=None):
+    # The first snapshot (YYYY-MM-DD) to recompute, or None if the whole history has to be built
+    if since is not None:
+        return since
+    last_snapshot = last_stored_snapshot(out_table, backend)
+    if last_snapshot is None:
+        return None
+    return last_snapshot.strftime('%Y-%m-%d')
+
+
+def read_stored_snapshot(out_table, backend, snapshot, columns=None, exclude=()):
+    # Reads back a single stored snapshot. Either only the listed `columns` are read, or all of them
+    # except the derived columns in `exclude` so that the rows can be stacked with freshly fetched ones.
+    if columns:
+        select = ", ".join(columns)
+    elif exclude:
+        select = "* except({0})".format(", ".join(exclude))
+    else:
+        select = "*"
+    query = "select {0} from {1} where date(snapshot) = '{2}'".format(
+        select, out_table, snapshot.strftime('%Y-%m-%d'))
+    return backend.read(query)
+
+
+def pending_periods(periods, since, curr_end):
+    # The period ends that need to be (re)computed: from `since` on and not beyond the current reporting week
+    since = pd.Timestamp(since)
+    curr_end = pd.Timestamp(curr_end)
+    return [p for p in periods if since <= p <= curr_end]
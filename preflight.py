@@ -0,0 +1,119 @@
+# Pre-flight cost estimate of a run and the query budget guard.
+#
+# Before the periods are fetched, the queries the run is going to issue (planned_queries in the scripts)
+# are dry-run through the backend, which gives the bytes each of them would scan without running it
+# (BigQuery dry run; DuckDB has none and returns None). Queries answered by the local cache cost nothing.
+#
+# Estimates are recorded in the --estimates file (JSON) under the hash of the normalised SQL text with its
+# date literals left out: a full-history query scans about the same bytes every week, so the estimates of
+# a BigQuery run stand in for the local backend, e.g. to test a query edit with --backend duckdb --dry-run.
+#
+# With --dry-run the scripts only report the estimate. With --budget-gb a rebuild over the budget falls back
+# to an incremental run from the last stored snapshot, and a run that is still over it is aborted before any
+# query ran. The base tables (--base-tables) are part of the estimate and only materialised once the run goes
+# ahead. A query without an estimate (no dry run, nothing recorded) could scan anything, so a run with one is
+# not within the budget either, unless --force is given.
+
+import hashlib
+import json
+import os
+import re
+
+import pandas as pd
+
+from query_cache import normalise_sql
+
+
+def estimate_key(sql):
+    text = re.sub(r"'\d{4}-\d{2}-\d{2}'", "'yyyy-mm-dd'", normalise_sql(sql))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def load_estimates(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_estimates(path, estimates):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(estimates, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def gigabytes(value):
+    return str(round(value / 1e9, 2)) + " GB"
+
+
+class BudgetGuard:
+
+    def __init__(self, backend, budget_gb=None, estimates_path=None, cache=None, force=False):
+        self.backend = backend
+        self.budget = None if budget_gb is None else budget_gb * 1e9
+        self.force = force
+        self.estimates_path = estimates_path
+        self.estimates = load_estimates(estimates_path)
+        self.cache = cache
+
+    def estimate(self, queries):
+        # queries: (label, sql, period_end) of the run. One row per query with the bytes it would scan and
+        # where the estimate comes from (cache, dry run, recorded or unknown)
+        rows = []
+        recorded = False
+        for label, sql, period_end in queries:
+            key = estimate_key(sql)
+            if self.cache is not None and self.cache.contains(sql, period_end):
+                rows.append((label, 0, 'cache'))
+                continue
+            scanned = self.backend.estimate(sql)
+            if scanned is not None:
+                self.estimates[key] = scanned
+                recorded = True
+                rows.append((label, scanned, 'dry run'))
+            elif key in self.estimates:
+                rows.append((label, self.estimates[key], 'recorded'))
+            else:
+                rows.append((label, None, 'unknown'))
+        if recorded and self.estimates_path is not None:
+            save_estimates(self.estimates_path, self.estimates)
+        return pd.DataFrame(rows, columns=['query', 'bytes', 'source'])
+
+    def total(self, estimate):
+        # bytes of the queries with an estimate
+        return float(estimate['bytes'].fillna(0).sum())
+
+    def unknown(self, estimate):
+        return int((estimate['source'] == 'unknown').sum())
+
+    def within(self, estimate):
+        if self.budget is None:
+            return True
+        return self.total(estimate) <= self.budget and (self.force or self.unknown(estimate) == 0)
+
+    def refusal(self, estimate):
+        # why a run that is not within the budget is aborted
+        if self.total(estimate) > self.budget:
+            return "The queries of the run would scan " + gigabytes(self.total(estimate)) + ", over the budget of " + gigabytes(self.budget)
+        return (str(self.unknown(estimate)) + " queries of the run have no estimate, run them with --dry-run on BigQuery "
+                "to record one or pass --force to run anyway")
+
+    def summary(self, estimate, name):
+        lines = [name + ": " + str(len(estimate)) + " queries, " + gigabytes(self.total(estimate)) + " to be scanned"
+                 + ("" if self.budget is None else " (budget " + gigabytes(self.budget) + ")")]
+        for source, rows in estimate.groupby('source', sort=False):
+            lines.append("  " + source + ": " + str(len(rows)) + " queries, " + gigabytes(float(rows['bytes'].fillna(0).sum())))
+        largest = estimate[estimate['bytes'] > 0].sort_values('bytes', ascending=False, kind='mergesort').head(3)
+        for row in largest.itertuples():
+            lines.append("  " + row.query + ": " + gigabytes(row.bytes))
+        if self.unknown(estimate):
+            lines.append("  without an estimate: " + ", ".join(estimate.loc[estimate['source'] == 'unknown', 'query'].head(5))
+                         + (", ..." if self.unknown(estimate) > 5 else ""))
+        return "\n".join(lines)
+
+
+def from_options(options, backend, cache=None):
+    # The guard configured on the command line, None without --dry-run and --budget-gb
+    if not options.dry_run and options.budget_gb is None:
+        return None
+    return BudgetGuard(backend, options.budget_gb, options.estimates, cache, options.force)
@@ -0,0 +1,142 @@
+# Local on-disk cache of query results.
+#
+# Every result is stored as a Parquet file under a key made from the hash of the normalised SQL text and
+# the period end, so a crashed or repeated run reads the periods it already downloaded from disk instead
+# of BigQuery. Entries expire after a TTL and the least recently used ones are evicted once the cache grows
+# beyond its size limit. Closed historical weeks (period ends before `pin_before`) can be pinned, pinned
+# entries never expire and are never evicted.
+#
+# The index of the entries is kept in index.json next to the Parquet files.
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import pandas as pd
+
+from frame_collector import convert_dates
+
+
+def normalise_sql(sql):
+    # whitespace and case of the SQL text do not change the result
+    return re.sub(r'\s+', ' ', sql).strip().lower()
+
+
+class QueryCache:
+
+    def __init__(self, cache_dir, ttl_hours=24, max_size_mb=None, pin_before=None):
+        self.cache_dir = cache_dir
+        self.ttl = None if ttl_hours is None else ttl_hours * 3600
+        self.max_size = None if max_size_mb is None else int(max_size_mb * 2**20)
+        self.pin_before = None if pin_before is None else pd.Timestamp(pin_before)
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    def key(self, sql, period_end=None):
+        text = normalise_sql(sql) + '|' + ('' if period_end is None else pd.Timestamp(period_end).strftime('%Y-%m-%d'))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def pinned(self, period_end):
+        return self.pin_before is not None and period_end is not None and pd.Timestamp(period_end) < self.pin_before
+
+    def get(self, sql, period_end=None):
+        key = self.key(sql, period_end)
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            path = os.path.join(self.cache_dir, entry['file'])
+            expired = not entry['pinned'] and self.ttl is not None and time.time() - entry['created'] > self.ttl
+            if expired or not os.path.exists(path):
+                self._remove(key)
+                self._save_index()
+                return None
+            entry['last_used'] = time.time()
+        return pd.read_parquet(path)
+
+    def contains(self, sql, period_end=None):
+        # whether get would find a result, without reading it
+        with self.lock:
+            entry = self.index.get(self.key(sql, period_end))
+            if entry is None or not os.path.exists(os.path.join(self.cache_dir, entry['file'])):
+                return False
+            return entry['pinned'] or self.ttl is None or time.time() - entry['created'] <= self.ttl
+
+    def put(self, sql, frame, period_end=None):
+        key = self.key(sql, period_end)
+        frame = convert_dates(frame)
+        path = os.path.join(self.cache_dir, key + '.parquet')
+        frame.to_parquet(path, index=False)
+
+        with self.lock:
+            now = time.time()
+            self.index[key] = {'file': key + '.parquet',
+                               'period_end': None if period_end is None else pd.Timestamp(period_end).strftime('%Y-%m-%d'),
+                               'pinned': self.pinned(period_end) or self.index.get(key, {}).get('pinned', False),
+                               'created': now,
+                               'last_used': now,
+                               'size': os.path.getsize(path)}
+            self._evict()
+            self._save_index()
+        return frame
+
+    def read(self, sql, read_fn, period_end=None):
+        # Cached result of sql, running read_fn(sql) on a miss
+        frame = self.get(sql, period_end)
+        if frame is None:
+            frame = self.put(sql, read_fn(sql), period_end)
+        return frame
+
+    def wrap(self, read):
+        # read(query, period_end) going through the cache
+        return lambda query, period_end=None: self.read(query, lambda q: read(q, period_end), period_end)
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+            self._save_index()
+
+    def _evict(self):
+        now = time.time()
+        for key, entry in list(self.index.items()):
+            if not entry['pinned'] and self.ttl is not None and now - entry['created'] > self.ttl:
+                self._remove(key)
+
+        if self.max_size is None:
+            return
+        total = sum(entry['size'] for entry in self.index.values())
+        unpinned = sorted((entry['last_used'], key) for key, entry in self.index.items() if not entry['pinned'])
+        for last_used, key in unpinned:
+            if total <= self.max_size:
+                break
+            total -= self.index[key]['size']
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.index.pop(key)
+        path = os.path.join(self.cache_dir, entry['file'])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _save_index(self):
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+
+
+def from_options(options, pin_before=None):
+    # The cache configured on the command line, None if caching is off
+    if options.cache_dir is None:
+        return None
+    return QueryCache(options.cache_dir, options.cache_ttl, options.cache_max_mb,
+                      pin_before if options.pin_closed_weeks else None)
@@ -0,0 +1,499 @@
+# Single pass event-replay engine for the weekly portfolio views.
+#
+# loans_by_period() in CBWeekly.py and CoverWeeklyUpdate.py rescans every transaction up to the period end
+# for every period, which makes the full history O(weeks x transactions). Here the CRB / ODR transactions
+# are pulled once, sorted by user and time and replayed a single time into a daily state: the state of
+# every user as of every day, kept as the days on which it changed (daily_state). The snapshot rows, with
+# the same columns the SQL produces, are then derived from it for any period grid (resample): the state as
+# of each period end, and the in-period flow columns from the cumulative flows at the period end and at the
+# end before it. Weekly, monthly and custom views all come from the same daily state.
+#
+# The portfolio specific business rules live in a policy:
+#   CreditBuildingPolicy - 67.50 / 30% minimum payment rule
+#   CoverPolicy          - "do not collect" rule, a user remains current if they make the $5 fee payment every month
+# with the due dates and aging buckets worked out on whole arrays by aging.py.
+#
+# Transactions without a user_reference (no match in accounts.kledger_accounts) are skipped.
+
+import numpy as np
+import pandas as pd
+
+import aging
+from aging import ONE_DAY
+
+
+def transactions_query(payment_codes, end, users=None):
+    # All transactions for the given payment codes up to the (last) period end, in Denver time
+    # (only those of the given user_references if users is given)
+    query = """select
+    b.user_reference,
+    a.UserAccount,
+    a.TransactionID,
+    DATETIME(a.PostedAt,'America/Denver') as PostedAt,
+    cast(trim(a.Amount,"$") as FLOAT64) as Amount,
+    a.PaymentCode
+    from kohoapi.transaction_succeeded_events as a
+        left join
+        (select distinct account_group_identifier, user_reference from accounts.kledger_accounts group by 1,2) as b
+            on a.UserAccount = b.account_group_identifier
+    where a.PaymentCode in ({0}) and date(a.PostedAt,'America/Denver') <= '{1}'""".format(
+        ", ".join("'" + code + "'" for code in payment_codes), end)
+    if users is not None:
+        query += "\n        and b.user_reference in ({0})".format(", ".join("'" + user + "'" for user in users))
+    return query
+
+
+def loans_query():
+    # Credit Building loan accounts, used for the account level columns of CBWeekly.py
+    return """select
+    account_identifier,
+    loan_type,
+    amount as CBLimit,
+    status,
+    datetime(created_at,'America/Denver') as created_at,
+    datetime(updated_at,'America/Denver') as updated_at
+    from feature.loans
+    where loan_type in ('creditbuilding')"""
+
+
+# Users flagged in the CoverMe view (grad_flag and migration_flag)
+grad_query = """select distinct user_reference from transaction.kledger_transaction_lines
+    where date(TIMESTAMP) >= '2022-10-12' and description = "Cover Funds (Limit Upgrade)" """
+
+migration_query = """select distinct string_field_0 as user_reference from credit.ep_migration_list"""
+
+
+def week_end(days):
+    # Sunday ending the ISO week of each datetime64[D] (last_day(..., ISOWEEK) in BigQuery).
+    # 1970-01-01 was a Thursday, i.e. weekday 3 with Monday = 0
+    weekday = (days.astype('int64') + 3) % 7
+    return days + (6 - weekday).astype('timedelta64[D]')
+
+
+def month_end(days):
+    return (days.astype('datetime64[M]') + 1).astype('datetime64[D]') - ONE_DAY
+
+
+def as_days(values):
+    return np.unique(pd.to_datetime(pd.Series(list(values))).to_numpy().astype('datetime64[D]'))
+
+
+def grid_cohort(grid):
+    # cohort for a custom grid: the first period end on or after the day (NaT after the last one)
+    grid = as_days(grid)
+
+    def cohort(days):
+        days = np.asarray(days, dtype='datetime64[D]')
+        position = np.searchsorted(grid, days)
+        found = position < len(grid)
+        return np.where(found, grid[np.minimum(position, len(grid) - 1)], np.datetime64('NaT'))
+    return cohort
+
+
+class DailyState:
+    # The state of every user as of every day, kept as the days on which it changed: one row per user and
+    # day with transactions (user_reference, day and the policy's state_columns), holding the state after
+    # the transactions of that day. The state on any other day is the one of the last change before it.
+    # accounts: the accounts of every user in the order they were first seen (user_reference,
+    # account_identifier, first_day)
+
+    def __init__(self, states, accounts):
+        self.states = states
+        self.accounts = accounts
+
+
+def daily_state(transactions, policy):
+    # transactions: frame with user_reference, UserAccount, PostedAt, Amount, PaymentCode
+    trans = policy.prepare(transactions[transactions['user_reference'].notnull()])
+    trans = trans.sort_values(['user_reference', 'PostedAt', 'rank'], kind='mergesort')
+
+    users = trans['user_reference'].to_numpy()
+    posted = trans['PostedAt'].to_numpy()
+    days = posted.astype('datetime64[D]')
+    kinds = trans['kind'].to_numpy()
+    amounts = trans['Amount'].to_numpy(dtype='float64')
+    accounts = trans['UserAccount'].to_numpy()
+
+    # row ranges of each user in the sorted transactions
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(users) else np.array([], dtype=int)
+    stops = np.r_[starts[1:], len(users)]
+
+    rows = []
+    for s, t in zip(starts, stops):
+        state = policy.start_user(users[s])
+        j = s
+        while j < t:
+            # every transaction of the day, then the state at the end of the day
+            day = days[j]
+            while j < t and days[j] == day:
+                policy.apply(state, kinds[j], posted[j], days[j], amounts[j], accounts[j])
+                j += 1
+            rows.append((state.user, day) + policy.record(state))
+
+    seen = trans[['user_reference', 'UserAccount']].assign(first_day=days)
+    seen = seen[~seen.duplicated(['user_reference', 'UserAccount'])] if len(seen) else seen
+    seen = seen.rename(columns={'UserAccount': 'account_identifier'}).reset_index(drop=True)
+    states = policy.finish(pd.DataFrame(rows, columns=['user_reference', 'day'] + policy.record_columns))
+    return DailyState(states, seen)
+
+
+def resample(daily, ends, policy, grid=None, cohort=None):
+    # Snapshot rows (policy.columns) of every user at the period ends, from the daily state.
+    # grid: every period end of the view, the period of an end starts after the grid point before it (prev_snap)
+    # and its flow columns cover the transactions in between. Weekly periods (week_end cohorts) by default.
+    ends = as_days(ends)
+    grid = np.r_[ends[:1] - 7 * ONE_DAY, ends] if grid is None else np.union1d(as_days(grid), ends)
+    cohort = week_end if cohort is None else cohort
+
+    states = daily.states
+    codes, users = pd.factorize(states['user_reference'])
+    days = states['day'].to_numpy().astype('datetime64[D]').astype('int64')
+    if len(states) == 0 or len(ends) == 0:
+        return pd.DataFrame(columns=policy.columns)
+
+    # the rows are sorted by user and day, so (user, day) packed into one integer is sorted as well
+    base = days.min()
+    packed = codes.astype('int64') * 2**22 + (days - base)
+    firsts = days[np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])]
+
+    # every user at every end on or after their first day, by user and end
+    user = np.repeat(np.arange(len(users)), len(ends))
+    end = np.tile(ends, len(users))
+    keep = end.astype('int64') >= firsts[user]
+    user, end = user[keep], end[keep]
+    position = np.searchsorted(grid, end)
+    prev = np.where(position > 0, grid[np.maximum(position - 1, 0)], np.datetime64('NaT'))
+    first_period = np.isnat(prev)
+
+    at = np.searchsorted(packed, user * 2**22 + (end.astype('int64') - base), side='right') - 1
+    prev_days = np.where(first_period, base, prev.astype('int64'))
+    before = np.searchsorted(packed, user * 2**22 + (prev_days - base), side='right') - 1
+    had = ~first_period & (before >= 0) & (codes[np.maximum(before, 0)] == user)
+
+    frame = states.iloc[at].reset_index(drop=True)
+    frame['snapshot'] = end
+    frame['prev_snap'] = prev
+    for column in policy.flow_columns:
+        # the flows are cumulative in the state, amounts are in cents
+        earlier = np.where(had, states[column].to_numpy()[np.maximum(before, 0)], 0)
+        frame[column] = np.round(frame[column].to_numpy() - earlier, 2)
+    return policy.snapshots(frame, daily.accounts, cohort)
+
+
+def replay(transactions, ends, policy, grid=None, cohort=None):
+    # The snapshot rows at the period ends, see daily_state and resample
+    return resample(daily_state(transactions, policy), ends, policy, grid, cohort)
+
+
+class _CBState:
+    __slots__ = ['user', 'accounts', 'loaned_accounts', 'os', 'last_tr', 'last_desc', 'last_withdraw',
+                 'repaid', 'repay_date', 'withdrawals', 'repayments']
+
+    def __init__(self, user):
+        self.user = user
+        self.accounts = []              # every account with a CRB transaction (all_trans)
+        self.loaned_accounts = set()    # accounts with at least one withdrawal (first_loan)
+        self.os = 0.0
+        self.last_tr = None
+        self.last_desc = None
+        self.last_withdraw = None
+        self.repaid = 0.0               # repaid since the last withdrawal (grouped_repay)
+        self.repay_date = None
+        self.withdrawals = 0.0          # flows since the first transaction
+        self.repayments = 0.0
+
+
+class CreditBuildingPolicy:
+
+    codes = ['CRB-CR-A-E-001', 'CRB-DR-A-E-001', 'CRB-DR-A-E-002', 'CRB-TR-A-I-001', 'CRB-TR-A-I-002']
+    withdraw_code = 'CRB-TR-A-I-001'
+    repay_code = 'CRB-TR-A-I-002'
+
+    columns = ['snapshot', 'accessed', 'user_reference', 'account_identifier', 'open_date', 'loan_type',
+               'CBLimit', 'snapshot_status', 'in_month_withdrawals', 'in_month_repayments', 'OS', 'due_date',
+               'prev_snap', 'cohort_end_month', 'cohort_end']
+
+    # daily state (record, then finish) and the cumulative flows among it
+    record_columns = ['accessed', 'os', 'last_tr', 'last_withdraw', 'repaid_last', 'repaid', 'prev_os',
+                      'withdrawals', 'repayments']
+    state_columns = ['accessed', 'os', 'due_day', 'withdrawals', 'repayments']
+    flow_columns = ['withdrawals', 'repayments']
+
+    def __init__(self, loans=None, min_payment=67.50, min_payment_rate=0.3, term_days=30, aging_edges=aging.AGING_EDGES):
+        # loans (loans_query) are only needed for the snapshots, not for the daily state or the status
+        self.min_payment = min_payment
+        self.min_payment_rate = min_payment_rate
+        self.term_days = term_days
+        self.aging_edges = aging_edges
+        self.labels = aging.bucket_labels('Current', 1, aging_edges)
+        if loans is None:
+            loans = pd.DataFrame(columns=['account_identifier', 'loan_type', 'CBLimit', 'status', 'created_at', 'updated_at'])
+
+        # open date from the first loan of the account, everything else from the latest one (min_date / max_date)
+        loans = loans.sort_values(['account_identifier', 'created_at'], kind='mergesort')
+        first = loans.groupby('account_identifier')['created_at'].min()
+        latest = loans.groupby('account_identifier').tail(1).set_index('account_identifier')
+        self.loans = pd.DataFrame({
+            'open_date': pd.to_datetime(first.reindex(latest.index)).to_numpy().astype('datetime64[D]'),
+            'loan_type': latest['loan_type'],
+            'CBLimit': latest['CBLimit'],
+            'loan_status': latest['status'],
+            'updated_day': pd.to_datetime(latest['updated_at']).to_numpy().astype('datetime64[D]')}, index=latest.index)
+
+    def prepare(self, transactions):
+        trans = transactions.copy()
+        trans['PostedAt'] = pd.to_datetime(trans['PostedAt'])
+        code = trans['PaymentCode'].to_numpy()
+        trans['kind'] = np.select([code == self.withdraw_code, code == self.repay_code], ['withdraw', 'repay'], 'other')
+        trans['rank'] = np.select([code == self.withdraw_code, code == self.repay_code], [0, 1], 2)
+        return trans
+
+    def start_user(self, user):
+        return _CBState(user)
+
+    def apply(self, state, kind, posted, day, amount, account):
+        if account not in state.accounts:
+            state.accounts.append(account)
+
+        if kind == 'withdraw':
+            state.loaned_accounts.add(account)
+            state.os += amount
+            state.last_tr = posted
+            state.last_desc = 'Borrow'
+            state.last_withdraw = posted
+            state.repaid = 0.0
+            state.repay_date = None
+            state.withdrawals += amount
+        elif kind == 'repay':
+            # weed out stray repayment transactions made before the first loan of the account
+            if account not in state.loaned_accounts:
+                return
+            state.os -= amount
+            state.last_tr = posted
+            state.last_desc = 'Repay'
+            if posted >= state.last_withdraw:
+                state.repaid += amount
+                state.repay_date = posted
+            state.repayments += amount
+
+    def record(self, state):
+        # the inputs of the due date, which does not depend on the snapshot, see finish
+        nat = np.datetime64('NaT', 'D')
+        if state.last_withdraw is None:
+            return (False, 0.0, nat, nat, False, 0.0, 0.0, state.withdrawals, state.repayments)
+        os = 0.0 if -0.01 <= state.os <= 0.01 else state.os
+        # Repayments are only taken into account if the last transaction is a repayment on the latest withdrawal
+        repaid_last = state.repay_date is not None and state.repay_date == state.last_tr
+        return (True, os, state.last_tr.astype('datetime64[D]'), state.last_withdraw.astype('datetime64[D]'), repaid_last,
+                state.repaid, state.repaid + state.os, state.withdrawals, state.repayments)
+
+    def finish(self, states):
+        # the due dates of every change point of the accessed users at once
+        due_day = aging.cb_due_day(states['last_tr'].to_numpy(), states['last_withdraw'].to_numpy(), states['repaid_last'].to_numpy(),
+                                   states['repaid'].to_numpy(), states['prev_os'].to_numpy(),
+                                   self.min_payment, self.min_payment_rate, self.term_days)
+        states['due_day'] = np.where(states['accessed'].to_numpy(dtype=bool), due_day, np.datetime64('NaT', 'D'))
+        return states[['user_reference', 'day'] + self.state_columns]
+
+    def status(self, os, due_day, end):
+        late = os > 0
+        return np.where(late, self.labels[aging.aging_bucket(aging.days_late(end, due_day), self.aging_edges)], "1. Current")
+
+    def status_as_of(self, state, end):
+        # OS, due date and status of user states (the state_columns) as of the days end, no status before the first withdrawal
+        accessed = np.asarray(state['accessed'], dtype=bool)
+        os = np.where(accessed, np.asarray(state['os'], dtype='float64'), 0.0)
+        due_day = np.where(accessed, np.asarray(state['due_day']).astype('datetime64[D]'), end)
+        return os, due_day, np.where(accessed, self.status(os, due_day, end), '')
+
+    def snapshots(self, frame, accounts, cohort):
+        os, due_day, status = self.status_as_of(frame, frame['snapshot'].to_numpy())
+        frame = frame.assign(os=os, due_day=due_day, status=status, row=np.arange(len(frame)))
+
+        # one row per account of the user seen by the snapshot, accounts without a loan are left out
+        accounts = accounts.assign(seq=np.arange(len(accounts)))
+        rows = frame.merge(accounts, on='user_reference')
+        rows = rows[rows['first_day'].to_numpy().astype('datetime64[D]') <= rows['snapshot'].to_numpy()]
+        rows = rows.merge(self.loans, left_on='account_identifier', right_index=True)
+        rows = rows.sort_values(['row', 'seq'], kind='mergesort')
+
+        end = rows['snapshot'].to_numpy()
+        updated = rows['updated_day'].to_numpy().astype('datetime64[D]')
+        cancelled = (rows['loan_status'] == 'cancelled').to_numpy()
+        # remove any stale accounts
+        rows = rows[~(cancelled & (month_end(updated) < end))]
+        end = rows['snapshot'].to_numpy()
+        updated = rows['updated_day'].to_numpy().astype('datetime64[D]')
+        cancelled = (rows['loan_status'] == 'cancelled').to_numpy()
+        accessed = rows['accessed'].to_numpy(dtype=bool)
+        open_day = rows['open_date'].to_numpy().astype('datetime64[D]')
+
+        return pd.DataFrame({
+            'snapshot': end,
+            'accessed': np.where(accessed, 'Yes', 'No'),
+            'user_reference': rows['user_reference'].to_numpy(),
+            'account_identifier': rows['account_identifier'].to_numpy(),
+            'open_date': open_day,
+            'loan_type': rows['loan_type'].to_numpy(),
+            'CBLimit': rows['CBLimit'].to_numpy(),
+            'snapshot_status': np.select([accessed, cancelled & (updated <= end)], [rows['status'].to_numpy(), '6. Cancelled'], '1. Current'),
+            'in_month_withdrawals': rows['withdrawals'].to_numpy(),
+            'in_month_repayments': rows['repayments'].to_numpy(),
+            'OS': rows['os'].to_numpy(),
+            'due_date': rows['due_day'].to_numpy(),
+            'prev_snap': rows['prev_snap'].to_numpy(),
+            'cohort_end_month': month_end(open_day),
+            'cohort_end': cohort(open_day)}, columns=self.columns)
+
+
+class _CoverState:
+    __slots__ = ['user', 'os', 'first_loan', 'last_loan', 'last_fee', 'last_payment', 'num_fees',
+                 'loans', 'loaned', 'num_repayments', 'repaid']
+
+    def __init__(self, user):
+        self.user = user
+        self.os = 0.0
+        self.first_loan = None
+        self.last_loan = None
+        self.last_fee = None
+        self.last_payment = None
+        self.num_fees = 0               # fee payments after the last disbursal
+        self.loans = 0                  # flows since the first transaction
+        self.loaned = 0.0
+        self.num_repayments = 0
+        self.repaid = 0.0
+
+
+class CoverPolicy:
+
+    codes = ['ODR-DR-A-E-001', 'ODR-CR-A-E-001', 'ODR-DR-A-E-002']
+    fee_code = 'ODR-DR-A-E-001'
+    loan_code = 'ODR-CR-A-E-001'
+    repayment_code = 'ODR-DR-A-E-002'
+
+    columns = ['snapshot', 'user_reference', 'OS', 'last_loan_date', 'last_fee_date', 'last_payment_date',
+               'num_fee_payments', 'num_expected_fee_payments', 'orig_due_date', 'due_date', 'update_date',
+               'num_loans_in_month', 'total_loaned_in_month', 'num_repayments_in_month', 'total_repaid_in_month',
+               'prev_snap', 'cohort_end', 'cohort_paid', 'snapshot_status', 'grad_flag', 'migration_flag']
+
+    # daily state (see record) and the cumulative flows among it
+    state_columns = ['os', 'first_loan', 'last_loan', 'last_fee', 'last_payment', 'num_fees',
+                     'loans', 'loaned', 'num_repayments', 'repaid']
+    record_columns = state_columns
+    flow_columns = ['loans', 'loaned', 'num_repayments', 'repaid']
+
+    def __init__(self, grad_users=(), migration_users=(), do_not_collect_start='2022-05-01', term_days=30,
+                 aging_edges=aging.AGING_EDGES):
+        self.grad_users = set(grad_users)
+        self.migration_users = set(migration_users)
+        # loans disbursed after this date stay current as long as the monthly fee is paid
+        self.do_not_collect_start = np.datetime64(do_not_collect_start, 'D')
+        self.term_days = term_days
+        self.term = np.timedelta64(term_days, 'D')
+        self.aging_edges = aging_edges
+        self.labels = aging.bucket_labels('current', 2, aging_edges)
+
+    def prepare(self, transactions):
+        # The CoverMe view works on Denver dates. Within a day loans come first, so that a repayment or fee
+        # on the day of the disbursal is treated like the SQL does (PostedAt >= first_loan_date, fees > last_loan_date)
+        trans = transactions.copy()
+        trans['PostedAt'] = pd.to_datetime(trans['PostedAt']).dt.normalize()
+        code = trans['PaymentCode'].to_numpy()
+        trans['kind'] = np.select([code == self.loan_code, code == self.repayment_code], ['loan', 'repayment'], 'fee')
+        trans['rank'] = np.select([code == self.loan_code, code == self.repayment_code], [0, 1], 2)
+        # fees and repayments reduce the balance
+        trans['Amount'] = np.where(code == self.loan_code, trans['Amount'], -trans['Amount'])
+        return trans
+
+    def start_user(self, user):
+        return _CoverState(user)
+
+    def apply(self, state, kind, posted, day, amount, account):
+        if kind == 'loan':
+            if state.first_loan is None:
+                state.first_loan = day
+            state.last_loan = day
+            state.os += amount
+            state.num_fees = 0
+            state.loans += 1
+            state.loaned += amount
+        elif kind == 'repayment':
+            # need this to make sure that we don't somehow have to deal with an error where
+            # a re-payment is the very first transaction
+            if state.first_loan is not None:
+                state.os += amount
+            state.last_payment = day
+            state.num_repayments += 1
+            state.repaid -= amount
+        else:
+            state.last_fee = day
+            if state.last_loan is not None and day > state.last_loan:
+                state.num_fees += 1
+
+    def record(self, state):
+        # Amounts are in cents, rounding avoids floating point residue when a balance is fully repaid
+        nat = np.datetime64('NaT', 'D')
+        return (round(state.os, 2),
+                nat if state.first_loan is None else state.first_loan,
+                nat if state.last_loan is None else state.last_loan,
+                nat if state.last_fee is None else state.last_fee,
+                nat if state.last_payment is None else state.last_payment,
+                state.num_fees, state.loans, state.loaned, state.num_repayments, state.repaid)
+
+    def finish(self, states):
+        return states
+
+    def due_date(self, last_loan, last_fee, num_fees, end):
+        # the due date and the number of fee payments that were SUPPOSED to be made after disbursal
+        return aging.cover_due_day(last_loan, last_fee, num_fees, end, self.do_not_collect_start, self.term_days)
+
+    def status(self, os, due_day, end):
+        buckets = self.labels[aging.aging_bucket(aging.days_late(end, due_day), self.aging_edges)]
+        return np.select([os == 0, os > 0], ["1. Inactive", buckets], "7. Balance Issue")
+
+    def status_as_of(self, state, end):
+        # OS, due date and status of user states (the state_columns) as of the days end, no status before the first disbursal
+        os = np.asarray(state['os'], dtype='float64')
+        last_loan = np.asarray(state['last_loan']).astype('datetime64[D]')
+        expected, due_day = self.due_date(last_loan, state['last_fee'], state['num_fees'], end)
+        return os, due_day, np.where(np.isnat(last_loan), '', self.status(os, due_day, end))
+
+    def snapshots(self, frame, accounts, cohort):
+        # Users only show up once they had a disbursal
+        frame = frame[frame['first_loan'].notnull()]
+        end = frame['snapshot'].to_numpy()
+        os = frame['os'].to_numpy(dtype='float64')
+        last_loan = frame['last_loan'].to_numpy().astype('datetime64[D]')
+        last_fee = frame['last_fee'].to_numpy().astype('datetime64[D]')
+        last_payment = frame['last_payment'].to_numpy().astype('datetime64[D]')
+        num_fees = frame['num_fees'].to_numpy(dtype='int64')
+        expected, due_day = self.due_date(last_loan, last_fee, num_fees, end)
+        paid = ~np.isnat(last_payment)
+        users = frame['user_reference']
+
+        # in period flows are null when there were none (like the SQL left joins)
+        loans = frame['loans'].to_numpy() > 0
+        repayments = frame['num_repayments'].to_numpy() > 0
+
+        return pd.DataFrame({
+            'snapshot': end,
+            'user_reference': users.to_numpy(),
+            'OS': os,
+            'last_loan_date': last_loan,
+            'last_fee_date': last_fee,
+            'last_payment_date': last_payment,
+            'num_fee_payments': num_fees,
+            'num_expected_fee_payments': expected,
+            'orig_due_date': last_loan + self.term,
+            'due_date': due_day,
+            'update_date': np.where(paid & (last_payment >= last_loan), last_payment, last_loan),
+            'num_loans_in_month': np.where(loans, 1, np.nan),
+            'total_loaned_in_month': np.where(loans, frame['loaned'].to_numpy(dtype='float64'), np.nan),
+            'num_repayments_in_month': np.where(repayments, frame['num_repayments'].to_numpy(dtype='float64'), np.nan),
+            'total_repaid_in_month': np.where(repayments, frame['repaid'].to_numpy(dtype='float64'), np.nan),
+            'prev_snap': frame['prev_snap'].to_numpy(),
+            'cohort_end': cohort(last_loan),
+            'cohort_paid': np.where(paid, cohort(np.where(paid, last_payment, last_loan)), np.datetime64('NaT')),
+            'snapshot_status': self.status(os, due_day, end),
+            'grad_flag': users.isin(self.grad_users).to_numpy().astype('int64'),
+            'migration_flag': users.isin(self.migration_users).to_numpy().astype('int64')}, columns=self.columns)
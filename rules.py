@@ -0,0 +1,36 @@
+# A small vectorised rule engine for the classification columns of the weekly views.
+#
+# A rule table maps each output column to a list of (condition, label) rules in priority order and a
+# default label. A condition is a function of the whole frame returning a boolean Series / array, so each
+# column is evaluated with a single np.select instead of a Python function applied row by row:
+#
+#     status_rules = {
+#         'new_default': ([(lambda d: (d['snapshot_status'] == '6. 91+') & (d['prev_status'] != '6. 91+'), '1. Yes'),
+#                          (lambda d: d['snapshot_status'] == '6. 91+', '2. No')],
+#                         '3. NA'),
+#     }
+#     frame = rules.evaluate(frame, status_rules)
+#
+# Conditions that evaluate to null (e.g. comparisons against missing dates) count as False.
+# The output columns are categoricals of the labels of their rules.
+
+import numpy as np
+import pandas as pd
+
+
+def condition_mask(condition, frame):
+    mask = condition(frame)
+    if isinstance(mask, pd.Series):
+        return mask.fillna(False).to_numpy(dtype=bool)
+    return np.asarray(mask, dtype=bool)
+
+
+def evaluate(frame, table):
+    # Returns a copy of frame with one column per entry of the rule table
+    results = {}
+    for column, (rules, default) in table.items():
+        conditions = [condition_mask(condition, frame) for condition, label in rules]
+        labels = [label for condition, label in rules]
+        values = np.select(conditions, labels, default) if rules else np.full(len(frame), default)
+        results[column] = pd.Categorical(values, categories=sorted(set(labels + [default])))
+    return frame.assign(**results)
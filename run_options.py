@@ -0,0 +1,123 @@
+# Command line options shared by the weekly portfolio scripts (CBWeekly.py and CoverWeeklyUpdate.py)
+
+import argparse
+
+
+def parse_run_args(description, argv=None, add_arguments=None):
+    # add_arguments(parser) adds the options that only apply to one of the scripts
+    parser = argparse.ArgumentParser(description=description)
+
+    # By default only the weeks after the last snapshot stored in the output table are computed and appended.
+    # Use --rebuild if some data issues have been identified (after the issues have been fixed)
+    # in the underlying feeder files
+    parser.add_argument('--rebuild', action='store_true',
+                        help='regenerate every snapshot from scratch and replace the output table')
+    parser.add_argument('--since', default=None,
+                        help='incremental mode only: recompute the stored snapshots from this date (YYYY-MM-DD) onward')
+
+    # Where the queries run and the output is written (backends.py). duckdb runs everything against a local
+    # DuckDB file, e.g. loaded with fixture tables, so that a run can be reproduced and profiled without GCP access
+    parser.add_argument('--backend', choices=['bigquery', 'duckdb'], default='bigquery',
+                        help='data source and destination of the run')
+    parser.add_argument('--duckdb-path', default='local.duckdb',
+                        help='database file of the duckdb backend')
+    parser.add_argument('--fixtures', default=None,
+                        help='duckdb backend only: directory of <dataset>.<table>.parquet/.csv files loaded as tables first')
+
+    # sql: one query per period (loans_by_period). replay: pull the transactions once and replay them locally (replay_engine.py)
+    parser.add_argument('--engine', choices=['sql', 'replay'], default='sql',
+                        help='how the weekly snapshots are computed')
+
+    # Views at other granularities from the same daily state of the replay engine (replay_engine.resample)
+    parser.add_argument('--views', type=lambda value: value.split(','), default=['weekly'],
+                        help='comma separated views to produce: weekly, monthly and/or custom (replay engine only for all but weekly)')
+    parser.add_argument('--period-ends', type=lambda value: value.split(','), default=None,
+                        help='custom view: comma separated period ends (YYYY-MM-DD), the first one only opens the first period')
+    parser.add_argument('--custom-table', default=None,
+                        help='custom view: output table')
+
+    # Replay and classification of hash-partitioned users in worker processes (sharding.py)
+    parser.add_argument('--shards', type=int, default=1,
+                        help='replay engine only: number of user shards processed in parallel processes')
+    parser.add_argument('--shard-workers', type=int, default=None,
+                        help='maximum number of worker processes (the number of shards or cores by default)')
+
+    # Per-period BigQuery jobs run concurrently (fetch_pool.py)
+    parser.add_argument('--workers', type=int, default=4,
+                        help='maximum number of periods fetched at the same time')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='number of times a failed period fetch is retried')
+    parser.add_argument('--backoff', type=float, default=2.0,
+                        help='seconds to wait before the first retry, doubled on every further retry')
+
+    # Stacking of the per-period chunks (frame_collector.py)
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help='MB of fetched chunks to keep in memory before spilling them to Parquet '
+                             '(while fetching, the final stacked frame is held in full)')
+    parser.add_argument('--spill-dir', default=None,
+                        help='directory for spilled chunks (a temporary directory by default)')
+
+    # Local cache of query results (query_cache.py)
+    parser.add_argument('--cache-dir', default=None,
+                        help='directory for cached query results, caching is off unless given')
+    parser.add_argument('--cache-ttl', type=float, default=24,
+                        help='hours after which a cached result is fetched again')
+    parser.add_argument('--cache-max-mb', type=float, default=None,
+                        help='size limit of the cache, least recently used results are evicted beyond it')
+    parser.add_argument('--pin-closed-weeks', action='store_true',
+                        help='keep cached results of closed weeks permanently')
+
+    # Checkpoint / resume of the period loop (checkpoint.py)
+    parser.add_argument('--checkpoint-dir', default='.checkpoint',
+                        help='directory where fetched periods are kept until the run completes')
+    parser.add_argument('--no-checkpoint', dest='checkpoint_dir', action='store_const', const=None,
+                        help='do not record progress')
+    parser.add_argument('--fresh', action='store_true',
+                        help='ignore the progress of a previous failed run and fetch every period again')
+
+    # Account mapping and portfolio transactions materialised once per run (base_tables.py)
+    parser.add_argument('--base-tables', action='store_true',
+                        help='materialise the account mapping and the portfolio transactions into scratch tables first')
+    parser.add_argument('--scratch-dataset', default='scratch',
+                        help='dataset for the base tables')
+
+    # Partitioned upload of the output table (uploader.py)
+    parser.add_argument('--upload-dir', default='.upload',
+                        help='directory for the partition files and the manifest of uploaded partitions')
+
+    # Late-arriving transactions (change_detection.py)
+    parser.add_argument('--detect-changes', action='store_true',
+                        help='fingerprint the transactions per user and week and recompute the users whose earlier weeks changed')
+
+    # Pre-aggregated companion tables (cubes.py)
+    parser.add_argument('--cubes', action='store_true',
+                        help='also write the roll rate and vintage tables of the view next to the output table')
+
+    # Point-in-time status index of the users (status_index.py)
+    parser.add_argument('--status-index', metavar='DIR', default=None,
+                        help='write the status index of every user as of every day to DIR/<script>')
+
+    # Pre-flight estimate of the bytes the queries scan and the budget guard (preflight.py)
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only estimate the bytes the queries of the run would scan')
+    parser.add_argument('--budget-gb', type=float, default=None,
+                        help='fall back to an incremental run or abort if the queries would scan more than this')
+    parser.add_argument('--estimates', default='.estimates.json',
+                        help='file of recorded dry run estimates, used where the backend cannot dry-run')
+    parser.add_argument('--force', action='store_true',
+                        help='run within --budget-gb even if some queries have no estimate')
+
+    # Per-stage timings (run_report.py), always summarised at the end of the run
+    parser.add_argument('--report', metavar='PREFIX', default=None,
+                        help='write the stage report to PREFIX.json and PREFIX.csv')
+
+    if add_arguments is not None:
+        add_arguments(parser)
+
+    args = parser.parse_args(argv)
+    for name in args.views:
+        if name not in ('weekly', 'monthly', 'custom'):
+            parser.error("unknown view " + name)
+    if 'custom' in args.views and (not args.period_ends or args.custom_table is None):
+        parser.error("the custom view needs --period-ends and --custom-table")
+    return args
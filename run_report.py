@@ -0,0 +1,108 @@
+# Per-stage instrumentation of a weekly run.
+#
+# Each stage of a run is recorded as a span with its wall time, rows in and out and the peak RSS of the
+# process at its end. Queries run by the backend while a span is open are attributed to it (job ids, bytes
+# processed and slot-ms on BigQuery). At the end of the run the spans are printed as a short summary and
+# can be written to a JSON / CSV report:
+#
+#   report = RunReport('CBWeekly')
+#   backend.on_query = report.query
+#   with report.span('fetch') as span:
+#       stacked = stack_periods(ends, args, read)
+#       span['rows_out'] = len(stacked)
+
+import contextlib
+import csv
+import datetime
+import json
+import resource
+import sys
+import threading
+import time
+
+csv_columns = ['stage', 'seconds', 'rows_in', 'rows_out', 'peak_rss_mb', 'queries', 'bytes_processed', 'slot_ms']
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak /= 1024.0
+    return peak / 1024.0
+
+
+class RunReport:
+
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.datetime.now()
+        self.began = time.perf_counter()
+        self.spans = []
+        self.open = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage, rows_in=None):
+        record = {'stage': stage, 'seconds': None, 'rows_in': rows_in, 'rows_out': None, 'peak_rss_mb': None,
+                  'queries': 0, 'bytes_processed': 0, 'slot_ms': 0, 'job_ids': []}
+        began = time.perf_counter()
+        with self.lock:
+            self.open.append(record)
+        try:
+            yield record
+        finally:
+            with self.lock:
+                self.open.remove(record)
+            record['seconds'] = round(time.perf_counter() - began, 3)
+            record['peak_rss_mb'] = round(peak_rss_mb(), 1)
+            self.spans.append(record)
+
+    def query(self, stats):
+        # Called by the backend for every query / statement, possibly from the fetch threads.
+        # The query is attributed to the innermost open span
+        with self.lock:
+            if not self.open:
+                return
+            record = self.open[-1]
+            record['queries'] += 1
+            record['bytes_processed'] += stats.get('bytes_processed') or 0
+            record['slot_ms'] += stats.get('slot_ms') or 0
+            if stats.get('job_id'):
+                record['job_ids'].append(stats['job_id'])
+
+    def summary(self):
+        lines = [self.name + " finished in " + format_seconds(time.perf_counter() - self.began)]
+        for record in self.spans:
+            line = "  {0:<16}{1:>9}".format(record['stage'], format_seconds(record['seconds']))
+            if record['rows_in'] is not None or record['rows_out'] is not None:
+                line += "  rows {0} -> {1}".format(format_count(record['rows_in']), format_count(record['rows_out']))
+            line += "  peak {0:.0f} MB".format(record['peak_rss_mb'])
+            if record['queries']:
+                line += "  {0} queries".format(record['queries'])
+            if record['bytes_processed']:
+                line += ", {0:.2f} GB processed, {1} slot-s".format(record['bytes_processed'] / 1e9,
+                                                                     round(record['slot_ms'] / 1000.0))
+            lines.append(line)
+        return "\n".join(lines)
+
+    def write(self, prefix):
+        # <prefix>.json with every span (including the job ids), <prefix>.csv with one row per span
+        with open(prefix + '.json', 'w') as f:
+            json.dump({'name': self.name, 'started': self.started.isoformat(timespec='seconds'),
+                       'seconds': round(time.perf_counter() - self.began, 3), 'spans': self.spans}, f, indent=1)
+        with open(prefix + '.csv', 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=csv_columns, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(self.spans)
+
+
+def format_seconds(seconds):
+    if seconds >= 3600:
+        return "{0}h{1:02d}m".format(int(seconds // 3600), int(seconds % 3600 // 60))
+    if seconds >= 60:
+        return "{0}m{1:02d}s".format(int(seconds // 60), int(seconds % 60))
+    return "{0:.1f}s".format(seconds)
+
+
+def format_count(count):
+    return '-' if count is None else str(count)
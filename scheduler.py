@@ -0,0 +1,190 @@
+# Scheduler for the weekly runs.
+#
+# The weekly views used to be run by hand on the Monday after the week end. This process stays up instead
+# (with pandas, the clients and the local caches loaded) and polls watermarks on the source transactions:
+# the last day with transactions of the portfolios and the number of transactions in the last --lookback
+# days up to the last week end. As soon as the week is closed and its data is complete, i.e. transactions of
+# a later day have landed and the number of transactions up to the week end did not change for --settle
+# polls, an incremental run of the pipeline is started in this process. The watermark query only reads the
+# transactions posted from --lookback days before the week end on (a filter on PostedAt itself, so that
+# BigQuery prunes the partitions), a poll does not scan the whole transaction table. A completed week is recorded in the state file and not run again.
+#
+# Runs are single-flight: they are made under an exclusive lock on the --lock file (fcntl), a trigger that
+# finds the lock taken, e.g. by another scheduler or by a run started with --once from cron, is skipped and
+# tried again on the next poll. A failed run is retried on the next poll as well.
+#
+#   python scheduler.py -- --engine replay --cache-dir .cache
+#   python scheduler.py --script CBWeekly --poll 300 -- --engine replay
+#   python scheduler.py --once -- --engine replay          (one poll, e.g. from cron)
+#
+# The options after -- are passed to the script for every run (and select the backend the watermarks are
+# read from).
+
+import argparse
+import contextlib
+import datetime
+import fcntl
+import importlib
+import json
+import os
+import sys
+import time
+import traceback
+
+import pandas as pd
+
+import backends
+import replay_engine
+from run_options import parse_run_args
+
+project_id = 'tensile-oarlock-191715'
+
+# The scripts that can be scheduled, with the payment codes whose transactions they need
+scripts = {'WeeklyBatch': replay_engine.CreditBuildingPolicy.codes + replay_engine.CoverPolicy.codes,
+           'CBWeekly': replay_engine.CreditBuildingPolicy.codes,
+           'CoverWeeklyUpdate': replay_engine.CoverPolicy.codes}
+
+
+def watermark_query(payment_codes, week_end, lookback=7):
+    # The last day with transactions and the number of transactions up to the week end (from lookback days
+    # before it on), in Denver time. The UTC day before the first Denver day bounds PostedAt
+    first = week_end - datetime.timedelta(days=lookback + 1)
+    return """select
+    max(date(PostedAt,'America/Denver')) as last_day,
+    sum(case when date(PostedAt,'America/Denver') <= '{1}' then 1 else 0 end) as transactions
+    from kohoapi.transaction_succeeded_events
+    where PaymentCode in ({0}) and PostedAt >= timestamp('{2}')""".format(
+        ", ".join("'" + code + "'" for code in payment_codes), week_end, first)
+
+
+def last_week_end(today):
+    # The Sunday ending the last completed week
+    return today - datetime.timedelta(days=today.weekday() + 1)
+
+
+def log(message):
+    print(str(datetime.datetime.now()) + " " + message, flush=True)
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+@contextlib.contextmanager
+def single_flight(path):
+    # Yields True while holding the exclusive lock on path, False (without waiting) if another process holds it
+    with open(path, 'a+') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            f.seek(0)
+            f.truncate()
+            f.write(str(os.getpid()) + "\n")
+            f.flush()
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def run_pipeline(name, argv):
+    # The script modules are reloaded first, so that their dates (curr_week_end, periods, ...) are the ones of today
+    for module_name in ['CBWeekly', 'CoverWeeklyUpdate', name]:
+        module = importlib.reload(importlib.import_module(module_name))
+    module.main(argv)
+
+
+def poll(args, run_argv, backend):
+    # One check of the watermarks, runs the pipeline if the last week is complete and not run yet
+    week_end = last_week_end(datetime.date.today())
+    state = load_state(args.state)
+    if state.get('completed') == str(week_end):
+        return
+
+    watermark = backend.read(watermark_query(scripts[args.script], week_end, args.lookback))
+    last_day = watermark['last_day'][0]
+    transactions = 0 if pd.isnull(watermark['transactions'][0]) else int(watermark['transactions'][0])
+    if pd.isnull(last_day) or pd.Timestamp(last_day).date() <= week_end:
+        log("Week ending " + str(week_end) + ": waiting for transactions after the week end")
+        return
+
+    # the week is complete once its number of transactions stops changing
+    if state.get('week_end') == str(week_end) and state.get('transactions') == transactions:
+        state['settled'] = state.get('settled', 0) + 1
+    else:
+        state.update(week_end=str(week_end), transactions=transactions, settled=0)
+    save_state(args.state, state)
+    if state['settled'] < args.settle:
+        log("Week ending " + str(week_end) + ": " + str(transactions) + " transactions, waiting for them to settle")
+        return
+
+    with single_flight(args.lock) as taken:
+        if not taken:
+            log("Week ending " + str(week_end) + ": another run holds " + args.lock + ", trying again on the next poll")
+            return
+        # another process may have completed the week while this one was polling
+        if load_state(args.state).get('completed') == str(week_end):
+            return
+        log("Week ending " + str(week_end) + ": running " + args.script + " " + " ".join(run_argv))
+        began = time.perf_counter()
+        try:
+            run_pipeline(args.script, run_argv)
+        except (Exception, SystemExit):
+            log("Run failed, trying again on the next poll\n" + traceback.format_exc())
+            return
+        state = load_state(args.state)
+        state['completed'] = str(week_end)
+        save_state(args.state, state)
+        log("Week ending " + str(week_end) + ": completed in " + str(round(time.perf_counter() - began)) + "s")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    run_argv = argv[argv.index('--') + 1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+
+    parser = argparse.ArgumentParser(description='Runs the weekly views as soon as the data of a week is complete')
+    parser.add_argument('--script', choices=sorted(scripts), default='WeeklyBatch',
+                        help='pipeline to run')
+    parser.add_argument('--poll', type=float, default=600,
+                        help='seconds between two checks of the watermarks')
+    parser.add_argument('--settle', type=int, default=1,
+                        help='number of polls the transactions up to the week end have to stay unchanged')
+    parser.add_argument('--lookback', type=int, default=7,
+                        help='days before the week end whose transactions are counted for the watermark')
+    parser.add_argument('--lock', default='.scheduler.lock',
+                        help='lock file that makes the runs single-flight')
+    parser.add_argument('--state', default='.scheduler.json',
+                        help='file recording the watermarks and the last completed week')
+    parser.add_argument('--once', action='store_true',
+                        help='check once and exit instead of polling')
+    args = parser.parse_args(argv)
+
+    # the run options also select the backend the watermarks are read from
+    options = parse_run_args('Options of ' + args.script, run_argv, importlib.import_module(args.script).add_arguments)
+    backend = backends.from_options(options, project_id)
+
+    log("Scheduling " + args.script + ", polling every " + str(args.poll) + "s")
+    while True:
+        try:
+            poll(args, run_argv, backend)
+        except Exception:
+            # e.g. the watermark query failed, the next poll tries again
+            log("Poll failed\n" + traceback.format_exc())
+        if args.once:
+            return
+        time.sleep(args.poll)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Sharded execution of the per-user stages.
+#
+# Everything the weekly scripts compute locally from the transactions (the replay, prev_status and the
+# classification flags) only looks at the rows of one user_reference at a time. In sharded mode the users
+# are hash-partitioned into shards and each shard is processed end to end in a worker process, the results
+# are merged at the end:
+#
+#   final = sharding.run(process_shard, {'transactions': transactions, 'ever': ever}, {'loans': loans},
+#                        shards=8, ends=ends, since=since)
+#
+# Frames are handed to and from the workers as Arrow IPC files in a temporary directory (in /dev/shm where
+# it exists) that are memory-mapped on reading, rather than pickled through the pool. Frames every shard
+# needs in full (e.g. feature.loans) are written once and mapped by every worker. The function has to be a
+# module level function, it is looked up by name in the worker. Workers are started from a fork server
+# rather than forked from the (possibly multi-threaded, e.g. WeeklyBatch.py) running process.
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from frame_collector import align_categories
+
+
+def shard_numbers(keys, shards):
+    # The same shard for the same key in every process and run. Missing keys go to shard 0
+    values = pd.Series(keys, dtype=object).fillna('').astype(str).to_numpy(dtype=object)
+    return (pd.util.hash_array(values) % np.uint64(shards)).astype('int64')
+
+
+def write_ipc(frame, path):
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def read_ipc(path):
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def run_shard(func, directory, shard, sharded, shared, kwargs):
+    frames = {name: read_ipc(os.path.join(directory, name + '-' + str(shard) + '.arrow')) for name in sharded}
+    frames.update({name: read_ipc(os.path.join(directory, name + '.arrow')) for name in shared})
+    path = os.path.join(directory, 'result-' + str(shard) + '.arrow')
+    write_ipc(func(**frames, **kwargs), path)
+    return path
+
+
+def run(func, sharded, shared=None, key='user_reference', shards=4, workers=None, **kwargs):
+    # func(**frames, **kwargs) returns the result frame of one shard, sharded frames are split by key,
+    # shared ones are handed to every shard in full. Returns the results of the shards one after the other
+    shared = shared or {}
+    directory = tempfile.mkdtemp(prefix='shards-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        for name, frame in sharded.items():
+            numbers = shard_numbers(frame[key], shards)
+            for shard in range(shards):
+                write_ipc(frame[numbers == shard], os.path.join(directory, name + '-' + str(shard) + '.arrow'))
+        for name, frame in shared.items():
+            write_ipc(frame, os.path.join(directory, name + '.arrow'))
+
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        with ProcessPoolExecutor(max_workers=workers or min(shards, os.cpu_count() or 1), mp_context=context) as pool:
+            futures = [pool.submit(run_shard, func, directory, shard, list(sharded), list(shared), kwargs)
+                       for shard in range(shards)]
+            paths = [future.result() for future in futures]
+        results = [read_ipc(path) for path in paths]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return pd.concat(align_categories(results), ignore_index=True)
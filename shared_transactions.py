@@ -0,0 +1,65 @@
+# One transaction pull shared by both portfolios.
+#
+# With the replay engine (replay_engine.py) CBWeekly.py and CoverWeeklyUpdate.py each pull their transactions
+# with transactions_query(), i.e. each scans kohoapi.transaction_succeeded_events and accounts.kledger_accounts
+# on its own. The two queries only differ in the payment codes (CRB-* and ODR-*), so the weekly batch
+# (WeeklyBatch.py) pulls the transactions for the union of the codes once, up to the latest period end of
+# either portfolio, and answers the transactions query of each portfolio from it:
+#
+#   shared = SharedTransactions([CreditBuildingPolicy.codes, CoverPolicy.codes], end)
+#   read = shared.wrap(read)
+#
+# The pull happens on the first transactions query and is released once every portfolio got its share.
+# Any other query (e.g. the recompute of a few users with --detect-changes) is passed on to read.
+
+import threading
+
+import pandas as pd
+
+import replay_engine
+
+
+class SharedTransactions:
+
+    def __init__(self, portfolios, end):
+        # portfolios: the payment codes of each portfolio, end: the latest period end any of them asks for
+        self.portfolios = [list(codes) for codes in portfolios]
+        self.codes = sorted(set(code for codes in self.portfolios for code in codes))
+        self.end = pd.Timestamp(end)
+        self.transactions = None
+        self.served = set()
+        self.lock = threading.Lock()
+
+    def portfolio(self, sql, period_end):
+        # position of the portfolio whose transactions query sql is, None for any other query
+        if period_end is None or pd.Timestamp(period_end) > self.end:
+            return None
+        end = pd.Timestamp(period_end).strftime('%Y-%m-%d')
+        for position, codes in enumerate(self.portfolios):
+            if sql == replay_engine.transactions_query(codes, end):
+                return position
+        return None
+
+    def share(self, read, position, period_end):
+        with self.lock:
+            if position in self.served:
+                # asked again after the pull was released
+                return None
+            if self.transactions is None:
+                self.transactions = read(replay_engine.transactions_query(self.codes, self.end.strftime('%Y-%m-%d')), self.end)
+                self.transactions['PostedAt'] = pd.to_datetime(self.transactions['PostedAt'])
+            trans = self.transactions
+            self.served.add(position)
+            if len(self.served) == len(self.portfolios):
+                self.transactions = None
+
+        rows = trans['PaymentCode'].isin(self.portfolios[position]) & (trans['PostedAt'].dt.normalize() <= pd.Timestamp(period_end))
+        return trans[rows].reset_index(drop=True)
+
+    def wrap(self, read):
+        # read(query, period_end) answering the transactions queries of the portfolios from the shared pull
+        def shared_read(sql, period_end=None):
+            position = self.portfolio(sql, period_end)
+            found = None if position is None else self.share(read, position, period_end)
+            return read(sql, period_end) if found is None else found
+        return shared_read
@@ -0,0 +1,39 @@
+# Previous-snapshot lookup for the week over week columns of the weekly views.
+#
+# Every row needs a value (e.g. the status) of the same user / account on the previous weekly snapshot.
+# Rather than merging the stacked frame with a copy of itself on (user_reference, prev_snap), the frame is
+# sorted by key and snapshot once and the column is shifted by one row. The shifted value is kept where the
+# row before belongs to the same key and, if `expected` is given, is the expected previous snapshot, so a
+# missing week maps to `missing` rather than to an older snapshot. Linear after the sort and only the looked
+# up column is materialised.
+#
+#   curr_loans = curr_loans.sort_values(['user_reference', 'snapshot'], kind='mergesort').reset_index(drop=True)
+#   curr_loans['prev_status'] = previous_values(curr_loans, 'user_reference', 'snapshot_status',
+#                                               expected='prev_snap', missing='0. non existent')
+
+import pandas as pd
+
+
+def previous_values(frame, key, column, snapshot='snapshot', expected=None, earlier=None, missing=None):
+    # frame must be sorted by key and snapshot. Returns a Series aligned with frame.
+    # earlier: rows (key, snapshot, column) before the first snapshot in frame, e.g. the stored snapshot the
+    # incremental mode starts from, used for the rows whose previous snapshot is not in frame (needs expected)
+    keys = frame[key]
+    found = keys.eq(keys.shift()).to_numpy()
+    if expected is not None:
+        found = found & frame[snapshot].shift().eq(frame[expected]).to_numpy()
+
+    categorical = isinstance(frame[column].dtype, pd.CategoricalDtype)
+    values = frame[column].astype(object).shift().where(found)
+
+    if earlier is not None and expected is not None and len(earlier):
+        lookup = earlier.drop_duplicates([key, snapshot]).set_index([key, snapshot])[column].astype(object)
+        lookup.index = pd.MultiIndex.from_arrays([lookup.index.get_level_values(0).astype(object),
+                                                  pd.to_datetime(lookup.index.get_level_values(1)).astype('datetime64[ns]')])
+        rows = ~found
+        wanted = pd.MultiIndex.from_arrays([keys[rows].astype(object), pd.to_datetime(frame[expected][rows]).astype('datetime64[ns]')])
+        values[rows] = lookup.reindex(wanted).to_numpy()
+
+    if missing is not None:
+        values = values.fillna(missing)
+    return values.astype('category') if categorical else values
@@ -0,0 +1,186 @@
+# Point-in-time status index of the portfolio users.
+#
+# Questions like "what bucket was user X in on day D, and why?" otherwise need a rerun of loans_by_period for
+# that week or a scan of the whole output table. The replay engine already has the state of every user as of
+# every day (replay_engine.DailyState), so the scripts can also write it out (--status-index DIR) as a
+# compact index: for every user the sorted days on which the OS or the due date inputs changed, with the
+# state after that day, as plain numpy arrays in DIR/<script>/ that are memory-mapped on loading.
+#
+# The state as of any day is the one of the last change point on or before it, found by binary search; the
+# due date and the status as of the day are then worked out by the policy (status_as_of), as they move with
+# the date even without transactions. Nothing is read from BigQuery:
+#
+#   index = status_index.load('index/CBWeekly')
+#   index.lookup(['u1', 'u2'], '2023-03-05')
+#
+#   python status_index.py index/CBWeekly 2023-03-05 u1 u2
+#
+# The index covers the transactions up to the last period end of the run that wrote it (through).
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import replay_engine
+
+# (user, day) packed into one integer, like in replay_engine.resample
+DAY_BITS = 22
+
+
+def as_days(on):
+    # datetime64[D] of a day or days given as YYYY-MM-DD strings, datetimes or datetime64 values
+    return np.asarray(on).astype('datetime64[D]')
+
+
+class StatusIndex:
+
+    def __init__(self, users, keys, days, columns, policy, base, through):
+        # users: sorted user_references, keys: packed (user position, day - base) of every change point in
+        # order, days: the day of every change point, columns: the state after every change point by column
+        self.users = users
+        self.keys = keys
+        self.days = days
+        self.columns = columns
+        self.policy = policy
+        self.base = base
+        self.through = through
+
+    def __len__(self):
+        return len(self.keys)
+
+    def positions(self, users, on):
+        # change point of every (user, day), -1 where the user has none on or before the day
+        users = np.asarray(users, dtype=str)
+        on = np.broadcast_to(as_days(on), users.shape)
+        code = np.searchsorted(self.users, users)
+        known = (code < len(self.users)) & (self.users[np.minimum(code, len(self.users) - 1)] == users)
+        offset = np.maximum(on.astype('int64') - self.base, -1)
+        at = np.searchsorted(self.keys, code.astype('int64') * 2**DAY_BITS + offset, side='right') - 1
+        found = known & (at >= 0) & (self.keys[np.maximum(at, 0)] >> DAY_BITS == code)
+        return np.where(found, at, -1), on
+
+    def lookup(self, users, on):
+        # Status of the users as of the day(s) on (one day or one per user): the OS, due date and status as of
+        # the day, the day of the last change and the state after it. No status for unknown users and before
+        # the first change
+        at, on = self.positions(users, on)
+        found = at >= 0
+        rows = np.maximum(at, 0)
+        state = {name: values[rows] for name, values in self.columns.items()}
+        os, due_day, status = self.policy.status_as_of(state, on)
+        frame = pd.DataFrame({'user_reference': np.asarray(users, dtype=object), 'as_of': on,
+                              'status': np.where(found, status, ''),
+                              'OS': np.where(found, os, np.nan),
+                              'due_date': np.where(found, due_day, np.datetime64('NaT')),
+                              'days_late': np.where(found & ~np.isnat(due_day), (on - due_day) / replay_engine.ONE_DAY, np.nan),
+                              'changed': np.where(found, self.days[rows], np.datetime64('NaT'))})
+        for name, values in state.items():
+            frame[name] = pd.Series(values).where(found)
+        return frame
+
+    def status_of(self, user, on):
+        # lookup for one user and day without building a frame: (status, OS, due date, day of the last change)
+        at, on = self.positions([user], on)
+        if at[0] < 0:
+            return '', np.nan, np.datetime64('NaT', 'D'), np.datetime64('NaT', 'D')
+        os, due_day, status = self.policy.status_as_of({name: values[at] for name, values in self.columns.items()}, on)
+        return str(status[0]), float(os[0]), due_day[0], self.days[at[0]]
+
+    def history(self, user):
+        # Every change point of one user
+        at, on = self.positions([user], self.through)
+        if at[0] < 0:
+            return pd.DataFrame(columns=['day'] + list(self.columns))
+        start = np.searchsorted(self.keys, (self.keys[at[0]] >> DAY_BITS) << DAY_BITS)
+        frame = pd.DataFrame({name: values[start:at[0] + 1] for name, values in self.columns.items()})
+        frame.insert(0, 'day', self.days[start:at[0] + 1])
+        return frame
+
+    def save(self, directory):
+        # written next to the old index and swapped in at the end, so readers never see a partial index
+        work = directory.rstrip('/') + '.tmp'
+        shutil.rmtree(work, ignore_errors=True)
+        os.makedirs(work)
+        np.save(os.path.join(work, 'users.npy'), self.users)
+        np.save(os.path.join(work, 'keys.npy'), self.keys)
+        np.save(os.path.join(work, 'days.npy'), self.days)
+        for name, values in self.columns.items():
+            np.save(os.path.join(work, name + '.npy'), values)
+        with open(os.path.join(work, 'index.json'), 'w') as f:
+            json.dump({'policy': type(self.policy).__name__, 'columns': list(self.columns), 'base': int(self.base),
+                       'through': str(self.through)}, f, indent=1)
+
+        old = directory.rstrip('/') + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(directory):
+            os.rename(directory, old)
+        os.rename(work, directory)
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def build(daily, policy, through):
+    # The index of a replay_engine.DailyState, with the change points of the state columns that are not flows
+    states = daily.states
+    names = [name for name in policy.state_columns if name not in policy.flow_columns]
+    codes, users = pd.factorize(states['user_reference'], sort=True)
+    days = states['day'].to_numpy().astype('datetime64[D]')
+
+    # the daily state is sorted by user and day, a day is a change point if any of the columns moved since the day before
+    changed = np.r_[True, codes[1:] != codes[:-1]] if len(states) else np.array([], dtype=bool)
+    for name in names:
+        values = states[name].to_numpy()
+        same = values[1:] == values[:-1]
+        if values.dtype.kind in 'fM':
+            same |= pd.isnull(values[1:]) & pd.isnull(values[:-1])
+        changed[1:] |= ~same
+    changed = np.flatnonzero(changed)
+
+    columns = {}
+    for name in names:
+        values = states[name].to_numpy()[changed]
+        if values.dtype.kind == 'M':
+            values = values.astype('datetime64[D]')
+        columns[name] = values
+    base = int(days.astype('int64').min()) if len(days) else 0
+    days = days[changed]
+    keys = codes[changed].astype('int64') * 2**DAY_BITS + (days.astype('int64') - base)
+    return StatusIndex(np.asarray(users, dtype=str), keys, days, columns, policy, base,
+                       np.datetime64(pd.Timestamp(through).date(), 'D'))
+
+
+def load(directory, mmap=True):
+    # The arrays are memory-mapped, only the pages a lookup touches are read
+    with open(os.path.join(directory, 'index.json')) as f:
+        meta = json.load(f)
+    mode = 'r' if mmap else None
+    arrays = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode)
+              for name in ['users', 'keys', 'days'] + meta['columns']}
+    policy = getattr(replay_engine, meta['policy'])()
+    return StatusIndex(arrays['users'], arrays['keys'], arrays['days'], {name: arrays[name] for name in meta['columns']},
+                       policy, meta['base'], np.datetime64(meta['through'], 'D'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Status of portfolio users as of a day, from a status index')
+    parser.add_argument('directory', help='index directory, e.g. index/CBWeekly')
+    parser.add_argument('day', help='YYYY-MM-DD')
+    parser.add_argument('users', nargs='+', help='user_references')
+    parser.add_argument('--history', action='store_true', help='print every change point of the users as well')
+    args = parser.parse_args(argv)
+
+    index = load(args.directory)
+    if pd.Timestamp(args.day) > pd.Timestamp(index.through):
+        print("The index only covers the transactions up to " + str(index.through))
+    with pd.option_context('display.width', 200, 'display.max_columns', None):
+        print(index.lookup(args.users, args.day).to_string(index=False))
+        if args.history:
+            for user in args.users:
+                print("\n" + user)
+                print(index.history(user).to_string(index=False))
+
+if __name__ == '__main__':
+    main()
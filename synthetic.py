@@ -0,0 +1,170 @@
+# Synthetic Credit Building (CRB) and CoverMe (ODR) portfolios.
+#
+# Generates the source tables the weekly queries read, as fixture files for the DuckDB backend
+# (backends.py), so that the pipelines can be run and benchmarked at any size without production data:
+#   python synthetic.py --users 100000 --weeks 26 --out fixtures/100k
+#   python CBWeekly.py --backend duckdb --fixtures fixtures/100k --rebuild
+#
+# Every user takes a loan (CB withdrawal / Cover disbursal) every 30 days until they drop out or miss a
+# repayment. Each loan is repaid in full on time, in part, in full but late, or not at all. Cover users pay
+# the $5 fee once per loan unless they skip it. Generation is vectorised over users x loan cycles.
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+cycle_days = 30
+
+# Repayment behaviour shares, the rest of the loans are never repaid (and the user stops borrowing)
+default_behaviour = {'on_time': 0.75, 'partial': 0.1, 'late': 0.1}
+
+
+def loan_cycles(rng, open_day, total_days, behaviour):
+    # Loan cycles of every user as (user, cycle, loan day, outcome) arrays.
+    # outcome: 0 on time, 1 partial, 2 late, 3 never repaid
+    n = len(open_day)
+    cycles = total_days // cycle_days + 1
+    cycle = np.arange(cycles)
+
+    outcome = np.searchsorted(np.cumsum([behaviour['on_time'], behaviour['partial'], behaviour['late']]),
+                              rng.random((n, cycles)), side='right')
+    # a user keeps borrowing up to their first unpaid loan or until they drop out
+    unpaid = outcome == 3
+    first_unpaid = np.where(unpaid.any(axis=1), unpaid.argmax(axis=1), cycles)
+    dropout = rng.integers(1, cycles + 1, n)
+    loan_day = open_day[:, None] + cycle[None, :] * cycle_days + rng.integers(0, 5, (n, cycles))
+
+    valid = (cycle[None, :] <= first_unpaid[:, None]) & (cycle[None, :] < dropout[:, None]) & (loan_day < total_days)
+    user, cycle_of = np.nonzero(valid)
+    return user, cycle_of, loan_day[valid], outcome[valid]
+
+
+def repayments(rng, loan_day, amount, outcome):
+    # Repayment day and amount of every repaid loan (mask of the loans that are repaid)
+    repaid = outcome < 3
+    day = loan_day + np.where(outcome == 2, rng.integers(cycle_days + 1, 4 * cycle_days, len(loan_day)),
+                              rng.integers(1, cycle_days, len(loan_day)))
+    paid = np.where(outcome == 1, amount * rng.uniform(0.3, 0.9, len(amount)), amount)
+    return repaid, day, np.round(paid, 2)
+
+
+def events(accounts, user, day, amount, code):
+    return pd.DataFrame({'account': accounts[user], 'day': day, 'Amount': amount, 'PaymentCode': code})
+
+
+def generate(users=10000, weeks=26, start='2022-04-01', seed=0, behaviour=default_behaviour,
+             fee_skip=0.1, cb_share=0.6, cover_share=0.6):
+    # Returns {table name: DataFrame} for the source tables of both portfolios
+    rng = np.random.default_rng(seed)
+    total_days = weeks * 7
+    start = pd.Timestamp(start, tz='UTC')
+
+    user_reference = np.array(['user_%07d' % i for i in range(users)], dtype=object)
+    accounts = np.array(['acct_%07d' % i for i in range(users)], dtype=object)
+    in_cb = rng.random(users) < cb_share
+    in_cover = (rng.random(users) < cover_share) | ~in_cb
+    frames = []
+
+    # Credit Building: subscription fee and withdrawal at the start of every cycle, then the repayment
+    cb_users = np.nonzero(in_cb)[0]
+    cb_open = rng.integers(0, max(1, total_days // 2), len(cb_users))
+    cb_limit = rng.choice([200.0, 500.0, 1000.0], len(cb_users))
+    user, cycle, day, outcome = loan_cycles(rng, cb_open, total_days, behaviour)
+    amount = np.round(rng.uniform(0.1, 1.0, len(user)) * cb_limit[user], 2)
+    repaid, repay_day, repay_amount = repayments(rng, day, amount, outcome)
+    frames.append(events(accounts, cb_users[user], day, 10.0, 'CRB-DR-A-E-001'))
+    frames.append(events(accounts, cb_users[user], day, amount, 'CRB-TR-A-I-001'))
+    frames.append(events(accounts, cb_users[user][repaid], repay_day[repaid], repay_amount[repaid], 'CRB-TR-A-I-002'))
+
+    # CoverMe: disbursal every cycle, the $5 fee before the due date (unless skipped), then the repayment
+    cover_users = np.nonzero(in_cover)[0]
+    cover_open = rng.integers(0, max(1, total_days // 2), len(cover_users))
+    user, cycle, day, outcome = loan_cycles(rng, cover_open, total_days, behaviour)
+    amount = np.round(rng.uniform(20, 250, len(user)), 2)
+    repaid, repay_day, repay_amount = repayments(rng, day, amount, outcome)
+    fee = rng.random(len(user)) >= fee_skip
+    fee_day = day + rng.integers(cycle_days - 5, cycle_days, len(user))
+    frames.append(events(accounts, cover_users[user], day, amount, 'ODR-CR-A-E-001'))
+    frames.append(events(accounts, cover_users[user][fee], fee_day[fee], 5.0, 'ODR-DR-A-E-001'))
+    frames.append(events(accounts, cover_users[user][repaid], repay_day[repaid], repay_amount[repaid], 'ODR-DR-A-E-002'))
+
+    trans = pd.concat(frames, ignore_index=True)
+    trans = trans[trans['day'] < total_days]
+    # posted at a random time of the day
+    seconds = trans['day'].to_numpy() * 86400 + rng.integers(0, 86400, len(trans))
+    trans = pd.DataFrame({
+        'UserAccount': trans['account'].to_numpy(),
+        'PostedAt': start + pd.to_timedelta(seconds, unit='s'),
+        'Amount': trans['Amount'].to_numpy(),
+        'PaymentCode': trans['PaymentCode'].to_numpy()}).sort_values('PostedAt', kind='mergesort')
+    trans.insert(2, 'TransactionID', np.arange(1, len(trans) + 1))
+
+    cancelled = rng.random(len(cb_users)) < 0.1
+    created = start + pd.to_timedelta(cb_open - 1, unit='D')
+    loans = pd.DataFrame({
+        'account_identifier': accounts[cb_users],
+        'loan_type': 'creditbuilding',
+        'amount': cb_limit,
+        'status': np.where(cancelled, 'cancelled', 'active'),
+        'created_at': created,
+        'updated_at': created + pd.to_timedelta(rng.integers(1, total_days + 1, len(cb_users)), unit='D')})
+
+    mapping = pd.DataFrame({'account_group_identifier': accounts, 'user_reference': user_reference})
+
+    # A few Cover users graduated to a higher limit or were migrated
+    grad = cover_users[rng.random(len(cover_users)) < 0.02]
+    grad_lines = pd.DataFrame({
+        'user_reference': user_reference[grad],
+        'TIMESTAMP': pd.Timestamp('2022-10-12', tz='UTC') + pd.to_timedelta(rng.integers(0, 90, len(grad)), unit='D'),
+        'description': 'Cover Funds (Limit Upgrade)'})
+    migration = pd.DataFrame({'string_field_0': user_reference[cover_users[rng.random(len(cover_users)) < 0.01]]})
+
+    return {'kohoapi.transaction_succeeded_events': trans,
+            'feature.loans': loans,
+            'accounts.kledger_accounts': mapping,
+            'transaction.kledger_transaction_lines': grad_lines,
+            'credit.ep_migration_list': migration}
+
+
+def write_fixtures(tables, directory):
+    # <dataset>.<table>.parquet files, as loaded by DuckDBBackend.load_fixtures
+    os.makedirs(directory, exist_ok=True)
+    for name, frame in tables.items():
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        if name == 'kohoapi.transaction_succeeded_events':
+            # amounts are stored as text, e.g. '$12.5'
+            amount = pc.binary_join_element_wise('$', pc.cast(table['Amount'], pa.string()), '')
+            table = table.set_column(table.schema.get_field_index('Amount'), 'Amount', amount)
+        pq.write_table(table, os.path.join(directory, name + '.parquet'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic CRB / ODR portfolio as DuckDB fixture files')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--weeks', type=int, default=26)
+    parser.add_argument('--start', default='2022-04-01')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--on-time', type=float, default=default_behaviour['on_time'],
+                        help='share of loans repaid in full before the due date')
+    parser.add_argument('--partial', type=float, default=default_behaviour['partial'],
+                        help='share of loans repaid in part')
+    parser.add_argument('--late', type=float, default=default_behaviour['late'],
+                        help='share of loans repaid in full after the due date')
+    parser.add_argument('--fee-skip', type=float, default=0.1,
+                        help='share of Cover loans whose fee is not paid')
+    parser.add_argument('--out', required=True, help='fixture directory')
+    args = parser.parse_args(argv)
+
+    behaviour = {'on_time': args.on_time, 'partial': args.partial, 'late': args.late}
+    tables = generate(args.users, args.weeks, args.start, args.seed, behaviour, args.fee_skip)
+    write_fixtures(tables, args.out)
+    for name, frame in tables.items():
+        print(name + ": " + str(len(frame)) + " rows")
+
+if __name__ == '__main__':
+    main()
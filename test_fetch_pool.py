@@ -0,0 +1,59 @@
+# Checks of the concurrent period fetch (fetch_pool.py) with a local fake of read_gbq.
+
+import random
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+import fetch_pool
+
+
+class FakeRead:
+    # Answers a period after a random delay, failing the periods in `failures` that many times first
+
+    def __init__(self, failures=None, seed=0):
+        self.failures = dict(failures or {})
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+
+    def __call__(self, period):
+        with self.lock:
+            self.calls[period] = self.calls.get(period, 0) + 1
+            delay = self.random.uniform(0, 0.02)
+            failing = self.failures.get(period, 0) > 0
+            if failing:
+                self.failures[period] -= 1
+        time.sleep(delay)
+        if failing:
+            raise ConnectionError('transient failure of ' + period)
+        return pd.DataFrame({'snapshot': [pd.Timestamp(period)], 'rows': [1]})
+
+
+periods = [d.strftime('%Y-%m-%d') for d in pd.date_range('2022-04-03', periods=20, freq='W')]
+
+
+def test_frames_in_period_order_after_a_retry():
+    read = FakeRead(failures={periods[7]: 1})
+    frames = fetch_pool.fetch_all(periods, read, workers=6, sleep=lambda seconds: None)
+    assert [frame['snapshot'][0].strftime('%Y-%m-%d') for frame in frames] == periods
+    assert read.calls[periods[7]] == 2
+    assert all(read.calls[period] == 1 for period in periods if period != periods[7])
+
+
+def test_frames_handed_over_with_their_position():
+    received = {}
+    fetch_pool.fetch_all(periods, FakeRead(failures={periods[3]: 2}), workers=6, sleep=lambda seconds: None,
+                         on_result=lambda frame, position: received.__setitem__(position, frame))
+    assert sorted(received) == list(range(len(periods)))
+    assert all(received[i]['snapshot'][0].strftime('%Y-%m-%d') == period for i, period in enumerate(periods))
+
+
+def test_permanent_failure_is_raised():
+    read = FakeRead(failures={periods[5]: 10})
+    with pytest.raises(ConnectionError):
+        fetch_pool.fetch_all(periods, read, workers=6, retries=3, sleep=lambda seconds: None)
+    # the first attempt and three retries
+    assert read.calls[periods[5]] == 4
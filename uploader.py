@@ -0,0 +1,160 @@
+# Partitioned upload of the weekly views.
+#
+# Uploading the whole history as one DataFrame (to_gbq if_exists='replace') costs time and memory in
+# proportion to the full portfolio history every week. The output table is instead partitioned by snapshot
+# (one DAY partition per weekly snapshot) and each partition is written to a Parquet file with an explicit
+# schema, loaded from disk into its partition (replacing it) and removed again, one partition at a time.
+#
+# A manifest of the fingerprint of every uploaded partition is kept in upload_dir/<table>/manifest.json, so
+# partitions whose rows did not change since the last upload are skipped. The manifest is local state, so a
+# partition is only skipped if the table still holds as many rows for it as were uploaded (e.g. snapshots
+# deleted from the table are uploaded again). Without a manifest (first run, other machine) every partition
+# in scope is uploaded.
+#
+# A table created by the old unpartitioned upload is recreated partitioned by the next --rebuild; until then
+# incremental runs fall back to deleting and appending the recomputed snapshots.
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+def parquet_schema(frame):
+    # The same explicit schema for every partition, so that e.g. a column that is null throughout one
+    # partition is not written with a different type
+    fields = []
+    for column, dtype in frame.dtypes.items():
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            field_type = pa.timestamp('us')
+        elif pd.api.types.is_bool_dtype(dtype):
+            field_type = pa.bool_()
+        elif pd.api.types.is_integer_dtype(dtype):
+            field_type = pa.int64()
+        elif pd.api.types.is_float_dtype(dtype):
+            field_type = pa.float64()
+        else:
+            # text, categoricals
+            field_type = pa.string()
+        fields.append(pa.field(column, field_type))
+    return pa.schema(fields)
+
+
+def fingerprint(rows):
+    # Datetimes are hashed as their integer value, which depends on the unit (e.g. s from the replay engine,
+    # us after a round trip through Parquet / Arrow), so they are brought to one unit first
+    dates = [column for column, dtype in rows.dtypes.items() if pd.api.types.is_datetime64_any_dtype(dtype)]
+    if dates:
+        rows = rows.assign(**{column: rows[column].astype('datetime64[ns]') for column in dates})
+    return hashlib.sha1(pd.util.hash_pandas_object(rows, index=False).to_numpy().tobytes()).hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def stored_counts(table, backend, since=None, column='snapshot'):
+    # {YYYY-MM-DD: number of rows} of the partitions the table holds (from since on)
+    counts = backend.read("select date({0}) as partition, count(*) as num_rows from {1}{2} group by 1".format(
+        column, table, "" if since is None else " where date({0}) >= '{1}'".format(column, since)))
+    return dict(zip(pd.to_datetime(counts['partition']).dt.strftime('%Y-%m-%d'), counts['num_rows'].astype('int64')))
+
+
+def upload(frame, table, backend, since=None, column='snapshot', upload_dir='.upload'):
+    # since None: frame holds the full history, otherwise the snapshots from since (YYYY-MM-DD) on
+    state_dir = os.path.join(upload_dir, table)
+    os.makedirs(state_dir, exist_ok=True)
+    manifest_path = os.path.join(state_dir, 'manifest.json')
+    manifest = load_manifest(manifest_path)
+    exists = backend.has_table(table)
+
+    if exists and not backend.is_partitioned(table, column):
+        if since is not None:
+            print(table + " is not partitioned by " + column + ", replacing the rows instead. Run once with --rebuild to partition it")
+            backend.replace_partitions(frame, table, column, since)
+            return
+        exists = False
+    if since is None and (not exists or not manifest):
+        # full history without knowing what is stored: start from an empty (partitioned) table
+        backend.execute("drop table if exists " + table)
+        exists = False
+        manifest = {}
+
+    # what the table holds, a partition is only skipped if it is still there in full
+    stored = stored_counts(table, backend, since, column) if exists and manifest else {}
+
+    schema = parquet_schema(frame)
+    written = []
+    skipped = 0
+    for partition, rows in frame.groupby(frame[column].dt.normalize(), sort=True):
+        key = partition.strftime('%Y-%m-%d')
+        written.append(key)
+        rows_fingerprint = fingerprint(rows)
+        if exists and manifest.get(key) == rows_fingerprint and stored.get(key) == len(rows):
+            skipped += 1
+            continue
+
+        path = os.path.join(state_dir, key + '.parquet')
+        pq.write_table(pa.Table.from_pandas(rows, preserve_index=False).cast(schema), path)
+        backend.load_partition(path, table, column, partition, schema)
+        os.remove(path)
+        exists = True
+
+        # recorded as we go, so that a failed upload only repeats the partitions it did not get to
+        manifest[key] = rows_fingerprint
+        save_manifest(manifest_path, manifest)
+
+    # partitions in scope that are no longer produced
+    stale = [key for key in manifest if key not in written and (since is None or key >= since)]
+    if since is not None and exists and written:
+        backend.execute("delete from {0} where date({1}) >= '{2}' and date({1}) not in ({3})".format(
+            table, column, since, ", ".join("'" + key + "'" for key in written)))
+    elif stale:
+        backend.execute("delete from {0} where date({1}) in ({2})".format(
+            table, column, ", ".join("'" + key + "'" for key in stale)))
+    for key in stale:
+        del manifest[key]
+    save_manifest(manifest_path, manifest)
+
+    print("Uploaded " + str(len(written) - skipped) + " out of " + str(len(written)) + " partitions, "
+          + str(skipped) + " unchanged")
+
+
+def patch_rows(frame, table, backend, users, first, last, column='snapshot', key='user_reference', upload_dir='.upload',
+               batch=1000):
+    # Replaces the rows of `users` in the snapshots first..last (YYYY-MM-DD, inclusive) by the rows of frame,
+    # e.g. the recomputed snapshots of users with late-arriving transactions (change_detection.py)
+    users = list(users)
+    for i in range(0, len(users), batch):
+        backend.execute("delete from {0} where date({1}) between '{2}' and '{3}' and {4} in ({5})".format(
+            table, column, first, last, key, ", ".join("'" + user + "'" for user in users[i:i + batch])))
+    backend.write(frame, table, if_exists='append')
+    forget_partitions(table, first, last, upload_dir)
+
+
+def replace_snapshots(frame, table, backend, first, last, column='snapshot', upload_dir='.upload'):
+    # Replaces the snapshots first..last (YYYY-MM-DD, inclusive) by the rows of frame
+    if backend.has_table(table):
+        backend.execute("delete from {0} where date({1}) between '{2}' and '{3}'".format(table, column, first, last))
+    backend.write(frame, table, if_exists='append')
+    forget_partitions(table, first, last, upload_dir)
+
+
+def forget_partitions(table, first, last, upload_dir='.upload'):
+    # the replaced partitions no longer match their fingerprints
+    manifest_path = os.path.join(upload_dir, table, 'manifest.json')
+    manifest = load_manifest(manifest_path)
+    if manifest:
+        save_manifest(manifest_path, {partition: value for partition, value in manifest.items() if not first <= partition <= last})